@@ -25,7 +25,11 @@ import cherrypy
 import sglib
 import xmlobject
 import types
-import uuid
+import hashlib
+import json
+import threading
+import traceback
+import urlparse
 import os.path
 import sys
 import os
@@ -39,26 +43,40 @@ class SGRule(object):
 
 class IPSet(object):
     IPSET_TYPE = 'hash:ip'
-    def __init__(self, setname, ips):
+    def __init__(self, ips):
         self.ips = ips
-        self.name = setname
+        self.name = self.name_for(ips)
+    
+    @staticmethod
+    def name_for(ips):
+        # named after its members, so rules allowing the same peers share a set
+        members = sorted(set(ips))
+        return 'cs_' + hashlib.md5(','.join(members)).hexdigest()[:24]
     
     def create(self):
-        tmpname = str(uuid.uuid4()).replace('-', '')[0:30]
-        sglib.ShellCmd('ipset -N %s %s' % (tmpname, self.IPSET_TYPE))()
         try:
-            for ip in self.ips:
-                sglib.ShellCmd('ipset -A %s %s' % (tmpname, ip))()
+            sglib.ShellCmd('ipset -N %s %s' % (self.name, self.IPSET_TYPE))()
+        except Exception:
+            if not self.exists():
+                raise
+            cherrypy.log('%s already exists with the same members, no need to create new' % self.name)
+            return
+        
+        # not matched by any rule yet, so it can be filled in place
+        cherrypy.log('created new ipset: %s' % self.name)
+        try:
+            for ip in set(self.ips):
+                sglib.ShellCmd('ipset -A %s %s' % (self.name, ip))()
+        except Exception:
+            sglib.ShellCmd('ipset -X %s' % self.name)()
+            raise
             
-            try:
-                sglib.ShellCmd('ipset -N %s %s' % (self.name, self.IPSET_TYPE))()
-                cherrypy.log('created new ipset: %s' % self.name)
-            except Exception:
-                cherrypy.log('%s already exists, no need to create new' % self.name)
-        finally:
-            sglib.ShellCmd('ipset -W %s %s' % (tmpname, self.name))()
-            sglib.ShellCmd('ipset -F %s' % tmpname)()
-            sglib.ShellCmd('ipset -X %s' % tmpname)()
+    def exists(self):
+        try:
+            sglib.ShellCmd('ipset list %s' % self.name)()
+            return True
+        except Exception:
+            return False
             
     @staticmethod 
     def destroy_sets(sets_to_keep):
@@ -70,9 +88,97 @@ class IPSet(object):
                     sglib.ShellCmd('ipset destroy %s' % set_name)()
                     cherrypy.log('destroyed unused ipset: %s' % set_name)
         
+def _seqno(seq):
+    try:
+        return int(seq)
+    except (TypeError, ValueError):
+        return -1
+
+class RuleQueue(object):
+    '''
+    rules waiting to be applied, at most one set per vm
+
+    rules queued for a vm that already has rules waiting replace them, so a
+    burst of updates is applied once with the latest signature and sequence
+    number. Rules are applied one set at a time by a single worker thread,
+    as applying them rewrites the iptables tables and destroys the ipsets
+    not kept by the set being applied.
+    '''
+    def __init__(self, apply_rules):
+        self.apply_rules = apply_rules
+        self.cond = threading.Condition()
+        # vm name -> (signature, sequence number, rules document)
+        self.pending = {}
+        # vms with pending rules, oldest first
+        self.order = []
+        # vm name -> state of its latest rules and the last applied ones
+        self.status = {}
+        self.worker = None
+    
+    def start(self):
+        self.worker = threading.Thread(target=self._work, name='sg-worker')
+        self.worker.daemon = True
+        self.worker.start()
+    
+    def put(self, vm_name, sig, seq, doc):
+        with self.cond:
+            st = self.status.get(vm_name)
+            if st and _seqno(seq) < _seqno(st['sequenceNumber']):
+                cherrypy.log('ignoring rules of %s with sequence number %s, %s is newer' % (vm_name, seq, st['sequenceNumber']))
+                return False
+            
+            if vm_name in self.pending:
+                cherrypy.log('rules of %s with sequence number %s replace the queued %s' % (vm_name, seq, self.pending[vm_name][1]))
+            else:
+                self.order.append(vm_name)
+            self.pending[vm_name] = (sig, seq, doc)
+            
+            if not st:
+                st = {'appliedSignature': None, 'appliedSequenceNumber': None}
+                self.status[vm_name] = st
+            st.update({'state': 'queued', 'signature': sig, 'sequenceNumber': seq, 'error': None})
+            self.cond.notify()
+            return True
+    
+    def get_status(self, vm_name=None):
+        with self.cond:
+            if vm_name is not None:
+                st = self.status.get(vm_name)
+                return st and dict(st)
+            return dict([(n, dict(st)) for n, st in self.status.items()])
+    
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.order:
+                    self.cond.wait()
+                vm_name = self.order.pop(0)
+                (sig, seq, doc) = self.pending.pop(vm_name)
+                self.status[vm_name]['state'] = 'applying'
+            
+            error = None
+            try:
+                self.apply_rules(doc)
+            except Exception, e:
+                error = str(e)
+                cherrypy.log('failed to apply rules of %s with sequence number %s\n%s' % (vm_name, seq, traceback.format_exc()))
+            
+            with self.cond:
+                st = self.status[vm_name]
+                if error is None:
+                    st['appliedSignature'] = sig
+                    st['appliedSequenceNumber'] = seq
+                # unless newer rules were queued meanwhile
+                if vm_name not in self.pending:
+                    st['state'] = 'failed' if error else 'applied'
+                    st['error'] = error
+
 class SGAgent(object):
+    # the methods a request may name in its 'command' header
+    COMMANDS = ('set_rules', 'status', 'echo')
+
     def __init__(self):
-        pass
+        self.queue = RuleQueue(self._apply_rules)
     
     def _self_list(self, obj):
         if isinstance(obj, types.ListType):
@@ -83,6 +189,17 @@ class SGAgent(object):
     def set_rules(self, req):
         body = req.body
         doc = xmlobject.loads(body)
+        vm_name = doc.vmName.text_
+        self.queue.put(vm_name, doc.signature.text_, doc.sequenceNumber.text_, doc)
+        return json.dumps(self.queue.get_status(vm_name))
+    
+    def status(self, req):
+        vm_name = None
+        if req.query_string:
+            vm_name = urlparse.parse_qs(req.query_string).get('vmName', [None])[0]
+        return json.dumps(self.queue.get_status(vm_name))
+    
+    def _apply_rules(self, doc):
         vm_name = doc.vmName.text_
         vm_id = doc.vmId.text_
         vm_ip = doc.vmIp.text_
@@ -124,10 +241,11 @@ class SGAgent(object):
                     r.allowed_ips.remove('0.0.0.0/0')
                 
                 if r.allowed_ips:
-                    setname = '_'.join([chainname, r.protocol, r.start_port, r.end_port])
-                    ipset = IPSet(setname, r.allowed_ips)
-                    ipset.create()
-                    current_set_names.append(setname)
+                    ipset = IPSet(r.allowed_ips)
+                    setname = ipset.name
+                    if setname not in current_set_names:
+                        ipset.create()
+                        current_set_names.append(setname)
                     
                     if r.protocol == 'all':
                         cmd = ['iptables -I', chainname, '-m state --state NEW -m set --set', setname, direction, '-j', action]
@@ -178,7 +296,7 @@ class SGAgent(object):
         req = sglib.Request.from_cherrypy_request(cherrypy.request)
         cmd_name = req.headers['command']
         
-        if not hasattr(self, cmd_name):
+        if cmd_name not in self.COMMANDS:
             raise ValueError("SecurityGroupAgent doesn't have a method called '%s'" % cmd_name)           
         method = getattr(self, cmd_name)
         
@@ -191,7 +309,9 @@ class SGAgent(object):
         cherrypy.log.error_file = '/var/log/cs-securitygroup.log'
         cherrypy.server.socket_host = '0.0.0.0'
         cherrypy.server.socket_port = 9988
-        cherrypy.quickstart(SGAgent())
+        agent = SGAgent()
+        agent.queue.start()
+        cherrypy.quickstart(agent)
         
     @staticmethod 
     def stop():
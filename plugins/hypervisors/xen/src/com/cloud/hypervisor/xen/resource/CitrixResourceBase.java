@@ -2722,7 +2722,7 @@ public abstract class CitrixResourceBase implements ServerResource, HypervisorRe
             vmResponseMap.put(vmUUID, new VmStatsEntry(0, 0, 0, 0, "vm"));
         }
 
-        Object[] rrdData = getRRDData(conn, 2); // call rrddata with 2 for vm
+        Object[] rrdData = getRRDData(conn, 2, vmUUIDs); // call rrddata with 2 for vm
 
         if (rrdData == null) {
             return null;
@@ -2817,6 +2817,10 @@ public abstract class CitrixResourceBase implements ServerResource, HypervisorRe
     }
 
     protected Object[] getRRDData(Connection conn, int flag) {
+        return getRRDData(conn, flag, null);
+    }
+
+    protected Object[] getRRDData(Connection conn, int flag, List<String> vmUUIDs) {
 
         /*
          * Note: 1 => called from host, hence host stats 2 => called from vm, hence vm stats
@@ -2828,7 +2832,7 @@ public abstract class CitrixResourceBase implements ServerResource, HypervisorRe
                 stats = getHostStatsRawXML(conn);
             }
             if (flag == 2) {
-                stats = getVmStatsRawXML(conn);
+                stats = getVmStatsRawXML(conn, vmUUIDs);
             }
         } catch (Exception e1) {
             s_logger.warn("Error whilst collecting raw stats from plugin: ", e1);
@@ -2935,11 +2939,21 @@ public abstract class CitrixResourceBase implements ServerResource, HypervisorRe
     }
 
     protected String getVmStatsRawXML(Connection conn) {
+        return getVmStatsRawXML(conn, null);
+    }
+
+    protected String getVmStatsRawXML(Connection conn, List<String> vmUUIDs) {
         Date currentDate = new Date();
         String startTime = String.valueOf(currentDate.getTime() / 1000 - 1000);
 
+        if (vmUUIDs == null || vmUUIDs.isEmpty()) {
+            return callHostPlugin(conn, "vmops", "gethostvmstats", "collectHostStats", String.valueOf("false"), "consolidationFunction", _consolidationFunction, "interval", String
+                    .valueOf(_pollingIntervalInSeconds), "startTime", startTime);
+        }
+        // let the host keep only the cpu and vif columns of these VMs, averaged
+        // into one row; hosts with an older plugin ignore the extra arguments
         return callHostPlugin(conn, "vmops", "gethostvmstats", "collectHostStats", String.valueOf("false"), "consolidationFunction", _consolidationFunction, "interval", String
-                .valueOf(_pollingIntervalInSeconds), "startTime", startTime);
+                .valueOf(_pollingIntervalInSeconds), "startTime", startTime, "vmUUIDs", StringUtils.join(vmUUIDs, ","), "dataSources", "cpu,vif", "aggregate", "true");
     }
 
     protected State convertToState(Types.VmPowerState ps) {
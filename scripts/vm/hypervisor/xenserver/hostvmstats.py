@@ -18,34 +18,73 @@
 # $Id: hostvmstats.py 10054 2010-06-29 22:09:31Z abhishek $ $HeadURL: svn://svn.lab.vmops.com/repos/vmdev/java/scripts/vm/hypervisor/xenserver/hostvmstats.py $
 
 import XenAPI
-import urllib
 import time
 import logging
+import perfmon
+import rrdupdates
 logging.basicConfig(filename='/tmp/xapilog',level=logging.DEBUG)
                       
-def get_stats(session, collect_host_stats, consolidation_function, interval, start_time):
+def format_value(value):
+  # xapi spells NaN the way Java's Double.valueOf expects it
+  if value != value:
+    return "NaN"
+  return repr(value)
+
+def filter_stats(xml, vm_uuids=None, data_sources=None, aggregate=False):
+  """Keeps the columns of the given VMs and data source families only
+
+  vm_uuids restricts the vm columns, host columns are always kept.
+  data_sources are variable name prefixes, e.g. ['cpu', 'vif'].  With
+  aggregate the rows are replaced by a single one holding the average of
+  each column.  The result has the layout of the rrd_updates document.
+  """
+  parsed = rrdupdates.parse(xml)
+  columns = []
+  for col in xrange(parsed.columns):
+    fields = parsed.legend[col].split(':', 3)
+    if len(fields) != 4:
+      continue
+    (cf, kind, uuid, param) = fields
+    if kind == 'vm' and vm_uuids is not None and uuid not in vm_uuids:
+      continue
+    if data_sources is not None and not [ds for ds in data_sources if param.startswith(ds)]:
+      continue
+    columns.append(col)
+
+  # the parser holds the rows in chronological order
+  times = list(parsed.timestamps)
+  data = [parsed.data[col] for col in columns]
+  if aggregate:
+    if times:
+      times = times[-1:]
+    data = [[value] for value in perfmon.aggregate(data, ['avg'])['avg']]
+    if not times:
+      data = [[] for values in data]
+
+  out = ['<xport><meta>']
+  out.append('<start>%d</start><step>%d</step><end>%d</end>' % (parsed.start_time, parsed.step_time, parsed.end_time))
+  out.append('<rows>%d</rows><columns>%d</columns><legend>' % (len(times), len(columns)))
+  for col in columns:
+    out.append('<entry>%s</entry>' % parsed.legend[col])
+  out.append('</legend></meta><data>')
+  for row in xrange(len(times) - 1, -1, -1):
+    out.append('<row><t>%d</t>' % times[row])
+    for values in data:
+      out.append('<v>%s</v>' % format_value(values[row]))
+    out.append('</row>')
+  out.append('</data></xport>')
+  return ''.join(out)
+
+def get_stats(session, collect_host_stats, consolidation_function, interval, start_time, vm_uuids=None, data_sources=None, aggregate=False):
   try:
     
-    if collect_host_stats == "true" :
-    	url = "http://localhost/rrd_updates?"
-   	url += "session_id=" + session._session
-   	url += "&host=" + collect_host_stats
-    	url += "&cf=" + consolidation_function
-    	url += "&interval=" + str(interval)
-    	url += "&start=" + str(int(time.time())-100)
-    else :
-    	url = "http://localhost/rrd_updates?"
-   	url += "session_id=" + session._session
-   	url += "&host=" + collect_host_stats
-    	url += "&cf=" + consolidation_function
-    	url += "&interval=" + str(interval)
-    	url += "&start=" + str(int(time.time())-100)
-
-    logging.debug("Calling URL: %s",url)
-    sock = urllib.URLopener().open(url)
-    xml = sock.read()
-    sock.close()
+    start = int(time.time()) - 100
+    logging.debug("Fetching rrd_updates: host=%s cf=%s interval=%s start=%s", collect_host_stats, consolidation_function, interval, start)
+    xml = rrdupdates.get("localhost", session._session, start, interval, consolidation_function, collect_host_stats)
     logging.debug("Size of returned XML: %s",len(xml))
+    if vm_uuids is not None or data_sources is not None or aggregate:
+      xml = filter_stats(xml, vm_uuids, data_sources, aggregate)
+      logging.debug("Size of filtered XML: %s",len(xml))
     return xml
   except Exception,e:
     logging.exception("get_stats() failed")
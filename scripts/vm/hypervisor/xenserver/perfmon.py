@@ -1,11 +1,61 @@
 #!/usr/bin/python
 
-import pprint
+import array
+import os
+import re
 import XenAPI
+import Queue
+import socket
+import subprocess
+import threading
 import urllib
-from xml.dom import minidom
 import time
-import commands
+import util
+import rrdupdates
+from rrdupdates import RRDParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Maximum number of hosts whose rrd_updates are fetched at the same time
+MAX_FETCH_THREADS = 8
+
+# Unix socket of the perfmond collector, see perfmond.py
+COLLECTOR_SOCKET = '/var/run/cloud/perfmond.sock'
+# installed next to this module, /opt/xensource/sm or /usr/lib/xcp/sm on XCP-OSS
+COLLECTOR_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perfmond.py')
+
+NAN = float('nan')
+
+# Window aggregations a counter can be reduced with
+AGGREGATIONS = ('avg', 'min', 'max', 'p95', 'last')
+
+# Smoothing factors of the level and of the trend of the Holt forecast
+HOLT_ALPHA = 0.5
+HOLT_BETA = 0.3
+
+# Counters an autoscale policy can ask for.  A counter is a list of terms
+# (RRD variable pattern, reduction over the matching columns, scale) and its
+# value at each sample is the sum of scale * reduction(columns) over the
+# terms.  Units are those xapi records, apart from memory which is in MB.
+COUNTERS = {}
+
+def register_counter(name, terms):
+    COUNTERS[name] = [(re.compile('^%s$' % pattern), reduction, scale) for pattern, reduction, scale in terms]
+
+register_counter('cpu', [(r'cpu\d+', 'mean', 1.0)])
+register_counter('memory', [('memory_target', 'sum', 1.0 / 1048576),
+                            ('memory_internal_free', 'sum', -1.0 / 1024)])
+register_counter('network.rx', [(r'vif_\d+_rx', 'sum', 1.0)])
+register_counter('network.tx', [(r'vif_\d+_tx', 'sum', 1.0)])
+register_counter('disk.read', [(r'vbd_[a-z]+_read', 'sum', 1.0)])
+register_counter('disk.write', [(r'vbd_[a-z]+_write', 'sum', 1.0)])
+register_counter('disk.iops.read', [(r'vbd_[a-z]+_iops_read', 'sum', 1.0)])
+register_counter('disk.iops.write', [(r'vbd_[a-z]+_iops_write', 'sum', 1.0)])
+register_counter('disk.latency.read', [(r'vbd_[a-z]+_read_latency', 'mean', 1.0)])
+register_counter('disk.latency.write', [(r'vbd_[a-z]+_write_latency', 'mean', 1.0)])
 
 # Per VM dictionary (used by RRDUpdates to look up column numbers by variable names)
 class VMReport(dict):
@@ -45,6 +95,17 @@ class RRDUpdates:
         self.params['host'] = 'false'   # include data for host (as well as for VMs)
         self.params['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
         self.params['interval'] = '60'
+        self.rows = 0
+        self.columns = 0
+        self.start_time = 0
+        self.step_time = 0
+        self.end_time = 0
+        self.timestamps = array.array('l')
+        self.legend = []
+        self.data = []
+        self.vm_reports = {}
+        self.host_reports = {}
+        self.host_report = None
 
     def get_nrows(self):
         return self.rows
@@ -59,7 +120,7 @@ class RRDUpdates:
         return report.keys()
 
     def get_total_cpu_core(self, uuid):
-	report = self.vm_reports[uuid]
+        report = self.vm_reports[uuid]
         if not report:
             return 0
         else:
@@ -71,11 +132,13 @@ class RRDUpdates:
             return result
 
     def get_vm_data(self, uuid, param, row):
-	#pp = pprint.PrettyPrinter(indent=4) 
-	#pp.pprint(self.vm_reports)
         report = self.vm_reports[uuid]
         col = report[param]
-        return self.__lookup_data(col, row)
+        return self.data[col][row]
+
+    def get_vm_column(self, uuid, param):
+        """Returns the samples of a VM variable as an array, oldest first"""
+        return self.data[self.vm_reports[uuid][param]]
 
     def get_host_uuid(self):
         report = self.host_report
@@ -92,154 +155,665 @@ class RRDUpdates:
     def get_host_data(self, param, row):
         report = self.host_report
         col = report[param]
-        return self.__lookup_data(col, row)
+        return self.data[col][row]
 
     def get_row_time(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col + 1]
-        return float(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    def refresh(self, login, starttime, session, override_params):
+        return self.timestamps[row]
+
+    def refresh(self, login, starttime, session, override_params, cache_ttl=None):
         self.params['start'] = starttime
         params = override_params
-        params['session_id'] = session
         params.update(self.params)
-        paramstr = "&".join(["%s=%s" % (k, params[k]) for k in params])
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-	for host in login.host.get_all():
-		#print "http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr
-        	sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
-	        xmlsource = sock.read()
-        	sock.close()
-        	xmldoc = minidom.parseString(xmlsource)
-        	self.__parse_xmldoc(xmldoc)
-        	# Update the time used on the next run
-        	self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def lookup_metadata_bytag(name):
-            return int(self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
-            # rows = number of samples per variable
-        # columns = number of variables
-        self.rows = lookup_metadata_bytag('rows')
-        self.columns = lookup_metadata_bytag('columns')
+
+        def fetch_host(address):
+            return rrdupdates.get(address, session, params['start'], params['interval'],
+                                  params['cf'], params['host'], cache_ttl)
+
+        # Every host of the pool only reports the VMs resident on it, so all of
+        # them are fetched (concurrently) and merged into one store
+        local_uuid = rrdupdates.local_host_uuid()
+        addresses = []
+        for host_rec in login.host.get_all_records().values():
+            if host_rec['uuid'] == local_uuid:
+                # same cache key as hostvmstats, which asks the local xapi
+                addresses.append('localhost')
+            else:
+                addresses.append(str(host_rec['address']))
+        parsed = []
+        errors = []
+        for xmlsource in fetch_all(addresses, fetch_host):
+            if isinstance(xmlsource, Exception):
+                errors.append(str(xmlsource))
+            else:
+                parsed.append(RRDParser().parse(xmlsource))
+        if not parsed:
+            raise PerfMonException("Failed to fetch rrd_updates from any host of the pool: %s" % "; ".join(errors))
+        self.load(parsed)
+        # Update the time used on the next run
+        self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
+
+    def parse(self, xmlsource):
+        """Loads a single rrd_updates document, replacing any previously loaded data"""
+        self.load([RRDParser().parse(xmlsource)])
+
+    def load(self, parsed):
+        """Merges the documents of several hosts into one store indexed by VM uuid
+
+        Hosts may return a slightly different number of rows for the same
+        query; only the newest rows common to all of them are kept.
+        """
+        parsed = [p for p in parsed if p.rows > 0] or parsed[:1]
+        # rows = number of samples per variable
+        self.rows = min([p.rows for p in parsed])
         # These indicate the period covered by the data
-        self.start_time = lookup_metadata_bytag('start')
-        self.step_time = lookup_metadata_bytag('step')
-        self.end_time = lookup_metadata_bytag('end')
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
+        self.step_time = parsed[0].step_time
+        self.end_time = max([p.end_time for p in parsed])
+        self.start_time = max([p.start_time for p in parsed])
+        self.timestamps = parsed[0].timestamps[parsed[0].rows - self.rows:]
+        legend = []
+        data = []
+        for p in parsed:
+            offset = p.rows - self.rows
+            legend.extend(p.legend)
+            for col in range(p.columns):
+                if offset:
+                    data.append(p.data[col][offset:])
+                else:
+                    data.append(p.data[col])
+        self.__index(legend, data)
+
+    def extend(self, newer, max_rows):
+        """Appends the samples of a later refresh, keeping the newest max_rows rows
+
+        Variables missing on either side are padded with NaN, and variables
+        left without any sample in the window are dropped.
+        """
+        skip = 0
+        if self.rows:
+            last = self.timestamps[-1]
+            while skip < newer.rows and newer.timestamps[skip] <= last:
+                skip += 1
+        added = newer.rows - skip
+        drop = max(0, self.rows + added - max_rows)
+
+        columns = {}
+        for col in xrange(self.columns):
+            columns[self.legend[col]] = self.data[col]
+        for col in xrange(newer.columns):
+            entry = newer.legend[col]
+            if not entry in columns:
+                columns[entry] = array.array('d', [NAN]) * self.rows
+            columns[entry].extend(newer.data[col][skip:])
+
+        legend = []
+        data = []
+        for entry, column in columns.items():
+            if len(column) < self.rows + added:
+                column.extend(array.array('d', [NAN]) * (self.rows + added - len(column)))
+            del column[:drop]
+            for value in column:
+                if value == value:
+                    legend.append(entry)
+                    data.append(column)
+                    break
+
+        self.timestamps.extend(newer.timestamps[skip:])
+        del self.timestamps[:drop]
+        self.rows = len(self.timestamps)
+        if self.rows:
+            self.start_time = self.timestamps[0]
+        self.end_time = max(self.end_time, newer.end_time)
+        self.step_time = newer.step_time or self.step_time
+        self.__index(legend, data)
+
+    def __index(self, legend, data):
+        self.legend = []
+        self.data = []
         # vm_reports matches uuid to per VM report
-        if not hasattr(self,'vm_reports'):
-		self.vm_reports = {}
-        # There is just one host_report and its uuid should not change!
+        self.vm_reports = {}
+        # host_reports matches uuid to per host report, host_report is the first one
+        self.host_reports = {}
         self.host_report = None
         # Handle each column.  (I.e. each variable)
-        for col in range(self.columns):
-            self.__handle_col(col)
+        for col in xrange(len(legend)):
+            self.__handle_col(legend[col], data[col])
+        # columns = number of variables
+        self.columns = len(self.data)
 
-    def __handle_col(self, col):
+    def __handle_col(self, col_meta_data, column):
         # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
         # vm_or_host will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
         (cf, vm_or_host, uuid, param) = col_meta_data.split(':')
         if vm_or_host == 'vm':
             # Create a report for this VM if it doesn't exist
             if not uuid in self.vm_reports:
                 self.vm_reports[uuid] = VMReport(uuid)
-                # Update the VMReport with the col data and meta data
             vm_report = self.vm_reports[uuid]
-            vm_report[param] = col
+            # A VM is only resident on one host, keep the first copy seen
+            if param in vm_report:
+                return
+            # Update the VMReport with the col data and meta data
+            vm_report[param] = self.__add_col(col_meta_data, column)
         elif vm_or_host == 'host':
             # Create a report for the host if it doesn't exist
-            if not self.host_report:
-                self.host_report = HostReport(uuid)
-            elif self.host_report.uuid != uuid:
-                raise PerfMonException("Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid))
-                # Update the HostReport with the col data and meta data
-            self.host_report[param] = col
+            if not uuid in self.host_reports:
+                self.host_reports[uuid] = HostReport(uuid)
+                if not self.host_report:
+                    self.host_report = self.host_reports[uuid]
+            # Update the HostReport with the col data and meta data
+            self.host_reports[uuid][param] = self.__add_col(col_meta_data, column)
         else:
             raise PerfMonException("Invalid string in <legend>: %s" % col_meta_data)
 
-def getuuid(vm_name):
-    status, output = commands.getstatusoutput("xe vm-list | grep "+vm_name+" -B 1 | head -n 1 | awk -F':' '{print $2}' | tr -d ' '")
-    if (status != 0):
-	raise PerfMonException("Invalid vm name: %s" % vm_name)
-    return output
+    def __add_col(self, col_meta_data, column):
+        self.legend.append(col_meta_data)
+        self.data.append(column)
+        return len(self.data) - 1
 
-def get_vm_group_perfmon(args={}):
-    login = XenAPI.xapi_local()
-    login.login_with_password("","")
-    result = ""
+def fetch_all(items, fetch, max_threads=MAX_FETCH_THREADS):
+    """Calls fetch on all items on a bounded pool of threads
 
-    total_vm = int(args['total_vm'])
-    total_counter = int(args['total_counter'])
-    now = int(time.time()) / 60
-
-    # Get pool's info of this host
-    #pool = login.xenapi.pool.get_all()[0]
-    # Get master node's address of pool
-    #master = login.xenapi.pool.get_master(pool)
-    #master_address = login.xenapi.host.get_address(master)
-    session = login._session
+    Returns the results in the order of items, or the exception raised by
+    fetch for the ones that failed.
+    """
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for i in xrange(len(items)):
+        pending.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = fetch(items[i])
+            except Exception, e:
+                results[i] = e
+
+    threads = []
+    for i in xrange(min(max_threads, len(items))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+class VMResolver:
+    """Resolves VM name labels to uuids with a single XenAPI query
+
+    A cached entry is trusted while its uuid is in known_uuids.  Every
+    vmopspremium call imports this module afresh, so the cache only outlives
+    a call inside perfmond, which passes the VMs of its latest rrd_updates
+    fetch: a VM recreated under the same name stops reporting its old uuid
+    and is looked up again.
+    """
+    def __init__(self):
+        # name_label -> uuid
+        self.cache = {}
+
+    def resolve(self, xenapi, names, known_uuids=None):
+        result = {}
+        missing = []
+        for name in names:
+            uuid = self.cache.get(name)
+            if uuid and (known_uuids is None or uuid in known_uuids):
+                result[name] = uuid
+            elif name not in missing:
+                missing.append(name)
+        if not missing:
+            return result
 
+        expr = " or ".join(['field "name__label" = "%s"' % n.replace('"', '\\"') for n in missing])
+        domids = {}
+        for rec in xenapi.VM.get_all_records_where(expr).values():
+            name = rec['name_label']
+            if name not in missing or rec['is_a_template'] or rec['is_a_snapshot'] or rec['is_control_domain']:
+                continue
+            if name in domids and domids[name] != '-1' and rec['domid'] == '-1':
+                # prefer the running VM over a halted one with the same name
+                continue
+            domids[name] = rec['domid']
+            self.cache[name] = rec['uuid']
+            result[name] = rec['uuid']
+
+        for name in missing:
+            if name not in result:
+                self.cache.pop(name, None)
+                raise PerfMonException("Invalid vm name: %s" % name)
+        return result
+
+vm_resolver = VMResolver()
+
+def split_groups(args):
+    """Splits the args of a batched query into the args of each group
+
+    The args of group N are those prefixed with 'groupN.', e.g.
+    group2.vmname1 is the vmname1 argument of the second group.
+    """
+    groups = []
+    for group_count in xrange(1, int(args['total_group']) + 1):
+        prefix = 'group' + str(group_count) + '.'
+        group = {}
+        for key, value in args.items():
+            if key.startswith(prefix):
+                group[key[len(prefix):]] = value
+        groups.append(group)
+    return groups
+
+def get_max_duration(args):
+    if 'total_group' in args:
+        return max([0] + [get_max_duration(group) for group in split_groups(args)])
     max_duration = 0
-    for counter_count in xrange(1, total_counter + 1):
+    for counter_count in xrange(1, int(args['total_counter']) + 1):
         duration = int(args['duration' + str(counter_count)])
         if duration > max_duration:
             max_duration = duration
+    return max_duration
+
+def percentile(values, fraction):
+    """Linear interpolation between the closest ranks of sorted values"""
+    pos = fraction * (len(values) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def aggregate_python(series, functions):
+    results = {}
+    for function in functions:
+        results[function] = []
+    for values in series:
+        values = [v for v in values if v == v]
+        for function in functions:
+            if not values and function != 'count':
+                value = NAN
+            elif function == 'count':
+                value = len(values)
+            elif function == 'avg':
+                value = sum(values) / len(values)
+            elif function == 'min':
+                value = min(values)
+            elif function == 'max':
+                value = max(values)
+            elif function == 'p95':
+                ordered = values[:]
+                ordered.sort()
+                value = percentile(ordered, 0.95)
+            else:
+                value = values[-1]
+            results[function].append(value)
+    return results
+
+def aggregate_numpy(series, functions):
+    matrix = numpy.vstack([numpy.asarray(values, dtype=float) for values in series])
+    valid = ~numpy.isnan(matrix)
+    counts = valid.sum(axis=1)
+    empty = counts == 0
+    vms = numpy.arange(matrix.shape[0])
+    results = {}
+    for function in functions:
+        if function == 'count':
+            results[function] = [int(v) for v in counts]
+            continue
+        if function == 'avg':
+            value = numpy.where(valid, matrix, 0.0).sum(axis=1) / numpy.maximum(counts, 1)
+        elif function == 'min':
+            value = numpy.where(valid, matrix, numpy.inf).min(axis=1)
+        elif function == 'max':
+            value = numpy.where(valid, matrix, -numpy.inf).max(axis=1)
+        elif function == 'p95':
+            # NaN samples are sorted last
+            ordered = numpy.sort(matrix, axis=1)
+            pos = 0.95 * numpy.maximum(counts - 1, 0)
+            lo = pos.astype(int)
+            hi = numpy.minimum(lo + 1, numpy.maximum(counts - 1, 0))
+            value = ordered[vms, lo] + (ordered[vms, hi] - ordered[vms, lo]) * (pos - lo)
+        else:
+            last = matrix.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+            value = matrix[vms, last]
+        value = numpy.where(empty, NAN, value)
+        results[function] = [float(v) for v in value]
+    return results
+
+def aggregate(series, functions):
+    """Reduces every series (the samples of one VM) with every function at once
+
+    Returns {function: [value per series]}, NaN samples are ignored and a
+    series without any sample yields NaN.  Besides AGGREGATIONS, 'count'
+    gives the number of samples of each series.
+    """
+    if not series:
+        results = {}
+        for function in functions:
+            results[function] = []
+        return results
+    if numpy is not None:
+        return aggregate_numpy(series, functions)
+    return aggregate_python(series, functions)
+
+def trend_python(series, step, horizon):
+    slopes = []
+    forecasts = []
+    for values in series:
+        points = [(i, values[i]) for i in xrange(len(values)) if values[i] == values[i]]
+        if not points:
+            slopes.append(NAN)
+            forecasts.append(NAN)
+            continue
+        mean_x = float(sum([x for x, y in points])) / len(points)
+        mean_y = sum([y for x, y in points]) / len(points)
+        sxx = sum([(x - mean_x) ** 2 for x, y in points])
+        sxy = sum([(x - mean_x) * (y - mean_y) for x, y in points])
+        if sxx > 0:
+            slopes.append(sxy / sxx / step)
+        else:
+            slopes.append(0.0)
+
+        # the first two samples give the initial level and trend
+        (first, level) = points[0]
+        trend = 0.0
+        if len(points) > 1:
+            trend = (points[1][1] - level) / (points[1][0] - first)
+            (first, level) = points[1]
+        for value in values[first + 1:]:
+            if value != value:
+                # missing sample, follow the trend
+                level += trend
+            else:
+                previous = level
+                level = HOLT_ALPHA * value + (1 - HOLT_ALPHA) * (level + trend)
+                trend = HOLT_BETA * (level - previous) + (1 - HOLT_BETA) * trend
+        forecasts.append(level + trend * horizon / step)
+    return {'slope': slopes, 'forecast': forecasts}
+
+def trend_numpy(series, step, horizon):
+    matrix = numpy.vstack([numpy.asarray(values, dtype=float) for values in series])
+    valid = ~numpy.isnan(matrix)
+    counts = numpy.maximum(valid.sum(axis=1), 1)
+    x = numpy.arange(matrix.shape[1], dtype=float)
+    mean_x = numpy.where(valid, x, 0.0).sum(axis=1) / counts
+    mean_y = numpy.where(valid, matrix, 0.0).sum(axis=1) / counts
+    dx = numpy.where(valid, x - mean_x[:, numpy.newaxis], 0.0)
+    dy = numpy.where(valid, matrix - mean_y[:, numpy.newaxis], 0.0)
+    sxx = (dx * dx).sum(axis=1)
+    slope = (dx * dy).sum(axis=1) / numpy.where(sxx > 0, sxx, 1.0) / step
+    slope = numpy.where(valid.any(axis=1), slope, NAN)
+
+    # one Holt update per sample, for all the VMs at once; the first two
+    # samples of a VM give its initial level and trend
+    vms = matrix.shape[0]
+    level = numpy.empty(vms)
+    level.fill(NAN)
+    trend = numpy.zeros(vms)
+    first = numpy.zeros(vms)
+    seen = numpy.zeros(vms, dtype=int)
+    for col in xrange(matrix.shape[1]):
+        value = matrix[:, col]
+        ok = valid[:, col]
+        start = ok & (seen == 0)
+        second = ok & (seen == 1)
+        update = ok & (seen > 1)
+        follow = ~ok & (seen > 1)
+        smoothed = HOLT_ALPHA * value + (1 - HOLT_ALPHA) * (level + trend)
+        initial = (value - level) / numpy.maximum(col - first, 1)
+        new_trend = numpy.where(update, HOLT_BETA * (smoothed - level) + (1 - HOLT_BETA) * trend, trend)
+        trend = numpy.where(second, initial, new_trend)
+        level = numpy.where(update, smoothed, numpy.where(start | second, value, numpy.where(follow, level + trend, level)))
+        first = numpy.where(start, col, first)
+        seen += ok
+    forecast = level + trend * float(horizon) / step
+    return {'slope': [float(v) for v in slope], 'forecast': [float(v) for v in forecast]}
+
+def trend(series, step, horizon):
+    """Least-squares slope (per second) and Holt forecast horizon seconds ahead of every series
+
+    Returns {'slope': [value per series], 'forecast': [value per series]},
+    NaN samples are skipped and a series without any sample yields NaN.
+    """
+    if not series:
+        return {'slope': [], 'forecast': []}
+    if numpy is not None:
+        return trend_numpy(series, step, horizon)
+    return trend_python(series, step, horizon)
+
+def has_counter(rrd_updates, vm_uuid, counter):
+    """Whether a VM reports every column a registered counter is computed from"""
+    params = rrd_updates.vm_reports[vm_uuid].keys()
+    for pattern, reduction, scale in COUNTERS[counter]:
+        if not [param for param in params if pattern.match(param)]:
+            return False
+    return True
+
+def counter_series(rrd_updates, vm_uuid, counter, rows):
+    """Returns the per sample values of a registered counter over the newest rows of a VM"""
+    start = max(0, rrd_updates.get_nrows() - rows)
+    report = rrd_updates.vm_reports[vm_uuid]
+    series = None
+    for pattern, reduction, scale in COUNTERS[counter]:
+        columns = [rrd_updates.data[report[param]][start:] for param in report.keys() if pattern.match(param)]
+        if not columns:
+            # e.g. memory_internal_free without PV drivers
+            return [NAN] * (rrd_updates.get_nrows() - start)
+        if numpy is not None:
+            term = numpy.vstack([vector(c) for c in columns]).sum(axis=0)
+            if reduction == 'mean':
+                term /= len(columns)
+            term *= scale
+            if series is None:
+                series = term
+            else:
+                series += term
+        else:
+            if reduction == 'mean':
+                scale = scale / len(columns)
+            term = [sum(v) * scale for v in zip(*columns)]
+            if series is None:
+                series = term
+            else:
+                series = [a + b for a, b in zip(series, term)]
+    return series
+
+def vector(column):
+    """Wraps an array('d') column in a numpy vector without copying it"""
+    if not len(column):
+        return numpy.zeros(0)
+    return numpy.frombuffer(column)
+
+def group_report(rrd_updates, xenapi, args):
+    """Computes the counters of an autoscale VM group from a loaded RRDUpdates
+
+    The aggregation of counter N is chosen by the optional 'aggregationN'
+    argument, one of AGGREGATIONS, and defaults to avg.  Returns a dict per
+    counter holding the window actually covered by the samples and, for a
+    counter in COUNTERS, the value and the sample count of each VM and the
+    VMs missing one of its columns, whose values are NaN.  With a
+    'forecast' argument of N seconds, the slope of each VM and its value
+    projected N seconds after the last sample are added.
+    """
+    total_vm = int(args['total_vm'])
+    total_counter = int(args['total_counter'])
 
-    rrd_updates = RRDUpdates()
-    rrd_updates.refresh(login.xenapi, now * 60 - max_duration, session, {})
+    vm_names = [args['vmname' + str(vm_count)] for vm_count in xrange(1, total_vm + 1)]
+    vm_uuids = vm_resolver.resolve(xenapi, vm_names, rrd_updates.vm_reports)
+    step = rrd_updates.step_time or 60
+    nrows = rrd_updates.get_nrows()
+    horizon = None
+    if args.get('forecast'):
+        horizon = int(args['forecast'])
 
-    #for uuid in rrd_updates.get_vm_list():
+    report = []
+    for counter_count in xrange(1, total_counter + 1):
+        counter = args['counter' + str(counter_count)]
+        function = args.get('aggregation' + str(counter_count), 'avg')
+        if function not in AGGREGATIONS:
+            raise PerfMonException("Invalid aggregation for counter %s: %s" % (counter, function))
+        duration = int(args['duration' + str(counter_count)])
+        first = max(0, nrows - duration / step)
+        entry = {'counter': counter_count, 'name': counter, 'aggregation': function,
+                 'duration': duration, 'covered': (nrows - first) * step,
+                 'start': None, 'end': None, 'values': None, 'samples': None,
+                 'slope': None, 'forecast': None, 'missing': None}
+        if first < nrows:
+            entry['start'] = rrd_updates.get_row_time(first)
+            entry['end'] = rrd_updates.get_row_time(nrows - 1)
+        if counter in COUNTERS:
+            series = [counter_series(rrd_updates, vm_uuids[name], counter, nrows - first) for name in vm_names]
+            entry['missing'] = [name for name in vm_names if not has_counter(rrd_updates, vm_uuids[name], counter)]
+            results = aggregate(series, [function, 'count'])
+            entry['values'] = results[function]
+            entry['samples'] = results['count']
+            if horizon is not None:
+                entry.update(trend(series, step, horizon))
+        report.append(entry)
+    return report
+
+def encode_json(obj):
+    """Serializes nested dicts, lists, strings and numbers, NaN becomes null"""
+    if obj is None:
+        return 'null'
+    if isinstance(obj, dict):
+        items = [encode_json(str(key)) + ':' + encode_json(obj[key]) for key in obj.keys()]
+        return '{' + ','.join(items) + '}'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join([encode_json(item) for item in obj]) + ']'
+    if isinstance(obj, basestring):
+        return '"' + obj.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    if isinstance(obj, bool):
+        return str(obj).lower()
+    if isinstance(obj, float):
+        if obj != obj or obj in (float('inf'), float('-inf')):
+            return 'null'
+        return repr(obj)
+    return str(obj)
+
+def format_report(report, total_vm):
+    """Returns the legacy 'vm.counter:value,...' string of a group report"""
+    result = []
     for vm_count in xrange(1, total_vm + 1):
-	vm_name = args['vmname' + str(vm_count)]
-        vm_uuid = getuuid(vm_name)
-        #print "Got values for VM: " + str(vm_count) + " " + vm_uuid
-        for counter_count in xrange(1, total_counter + 1):
-	    #refresh average
-	    average_cpu = 0
-	    average_memory = 0
-            counter = args['counter' + str(counter_count)]
-            total_row = rrd_updates.get_nrows()
-            duration = int(args['duration' + str(counter_count)]) / 60
-            duration_diff = total_row - duration
-            if counter == "cpu":
-		total_cpu = rrd_updates.get_total_cpu_core(vm_uuid)
-                for row in xrange(duration_diff, total_row):
-                    for cpu in xrange(0, total_cpu):
-                        average_cpu += rrd_updates.get_vm_data(vm_uuid, "cpu" + str(cpu), row)
-                average_cpu /= (duration * total_cpu)
-                if result == "":
-                    result += str(vm_count) + '.' +  str(counter_count) + ':' + str(average_cpu)
-                else:
-                    result += ',' + str(vm_count) +  '.' + str(counter_count) + ':' + str(average_cpu)
-            elif counter == "memory":
-                for row in xrange(duration_diff, total_row):
-                    average_memory += rrd_updates.get_vm_data(vm_uuid, "memory_target", row) / 1048576 - rrd_updates.get_vm_data(vm_uuid, "memory_internal_free", row) / 1024
-                average_memory /= duration
-                if result == "":
-                    result += str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-                else:
-                    result += ',' + str(vm_count) +  '.' +  str(counter_count) + ':' + str(average_memory)
-    return result
+        for entry in report:
+            if entry['values'] is None:
+                # counter not supported
+                continue
+            if entry['missing']:
+                # the management server would take NaN for a measured value
+                raise PerfMonException("Counter %s is not reported by %s" % (entry['name'], ", ".join(entry['missing'])))
+            value = str(vm_count) + '.' + str(entry['counter']) + ':' + str(entry['values'][vm_count - 1])
+            if entry['forecast'] is not None:
+                value += ':' + str(entry['forecast'][vm_count - 1])
+            result.append(value)
+    return ','.join(result)
+
+def group_perfmon(rrd_updates, xenapi, args):
+    """Answers a group query, as JSON when args holds format=json"""
+    report = group_report(rrd_updates, xenapi, args)
+    if args.get('format') == 'json':
+        return encode_json({'step': rrd_updates.step_time, 'counters': report})
+    return format_report(report, int(args['total_vm']))
+
+def batch_perfmon(rrd_updates, xenapi, args):
+    """Computes the counters of several VM groups from one loaded RRDUpdates
+
+    Returns 'N=result' per group separated by ';', as the management server
+    strips the newlines of plugin output.  A group that cannot be computed
+    reports 'N=ERROR: reason' without failing the others.  With format=json
+    the groups are returned as one object keyed by N instead.
+    """
+    groups = split_groups(args)
+    names = []
+    for group in groups:
+        names.extend([group['vmname' + str(vm_count)] for vm_count in xrange(1, int(group['total_vm']) + 1)])
+    try:
+        # resolve the names of all groups in one XenAPI query
+        vm_resolver.resolve(xenapi, names, rrd_updates.vm_reports)
+    except PerfMonException:
+        # the group holding the invalid name reports it below
+        pass
+
+    as_json = args.get('format') == 'json'
+    result = []
+    reports = {}
+    for group_count in xrange(1, len(groups) + 1):
+        group = groups[group_count - 1]
+        try:
+            report = group_report(rrd_updates, xenapi, group)
+            if not as_json:
+                line = format_report(report, int(group['total_vm']))
+        except (PerfMonException, KeyError, ValueError), e:
+            reports[str(group_count)] = {'error': str(e)}
+            result.append(str(group_count) + '=ERROR: ' + str(e).replace(';', ','))
+            continue
+        reports[str(group_count)] = {'counters': report}
+        if not as_json:
+            result.append(str(group_count) + '=' + line)
+    if as_json:
+        return encode_json({'step': rrd_updates.step_time, 'groups': reports})
+    return ';'.join(result)
+
+def query_perfmon(rrd_updates, xenapi, args):
+    if 'total_group' in args:
+        return batch_perfmon(rrd_updates, xenapi, args)
+    return group_perfmon(rrd_updates, xenapi, args)
+
+def query_collector(args, timeout=10):
+    """Asks the perfmond collector to answer a perfmon query from memory"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(COLLECTOR_SOCKET)
+        sock.sendall(urllib.urlencode(args) + "\n")
+        reply = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply.append(chunk)
+    finally:
+        sock.close()
+    reply = "".join(reply)
+    if reply.startswith("ERROR:"):
+        raise PerfMonException(reply[len("ERROR:"):].strip())
+    return reply
+
+def start_collector():
+    if not os.path.exists(COLLECTOR_SCRIPT):
+        util.SMlog("perfmon: collector %s is not installed" % COLLECTOR_SCRIPT)
+        return
+    try:
+        subprocess.call([COLLECTOR_SCRIPT, "start"], close_fds=True)
+    except OSError, e:
+        util.SMlog("perfmon: failed to start collector %s: %s" % (COLLECTOR_SCRIPT, str(e)))
 
+def get_vm_group_perfmon(args={}):
+    if args.get('collector', 'true') != 'false':
+        try:
+            return query_collector(args)
+        except socket.error, e:
+            # not running yet, answer directly this time
+            util.SMlog("perfmon: collector unavailable (%s), fetching rrd_updates directly" % str(e))
+            start_collector()
+        except PerfMonException, e:
+            # e.g. it does not hold enough history yet
+            util.SMlog("perfmon: collector cannot answer (%s), fetching rrd_updates directly" % str(e))
+
+    login = XenAPI.xapi_local()
+    login.login_with_password("","")
+    try:
+        now = int(time.time()) / 60
+        rrd_updates = RRDUpdates()
+        rrd_updates.refresh(login.xenapi, now * 60 - get_max_duration(args), login._session, {})
+        return query_perfmon(rrd_updates, login.xenapi, args)
+    finally:
+        login.xenapi.session.logout()
+
+def get_vm_groups_perfmon(args={}):
+    """Batched get_vm_group_perfmon answering total_group groups at once
+
+    The rrd_updates are fetched and parsed once for the largest window of
+    all groups, see split_groups and batch_perfmon for args and result.
+    """
+    if 'total_group' not in args:
+        raise PerfMonException("total_group is missing")
+    return get_vm_group_perfmon(args)
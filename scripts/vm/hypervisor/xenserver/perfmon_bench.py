@@ -0,0 +1,354 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# This is for test purpose, to measure perfmon.py without a live XenServer.
+#
+# usage: perfmon_bench.py synthetic [--vms 10,100,500] [--rows 60] [options]
+#        perfmon_bench.py record DIR --url http://host --user root --password pw
+#        perfmon_bench.py replay DIR... [options]
+#
+# record saves the rrd_updates of every host of a pool and the VM records
+# into DIR, replay and synthetic run those payloads through RRDUpdates and
+# get_vm_group_perfmon against a stubbed XenAPI and report the parse time,
+# the aggregation time, the end to end time and the peak memory.
+
+import os
+import resource
+import sys
+import time
+import types
+from xml.dom import minidom
+
+try:
+    import XenAPI
+except ImportError:
+    XenAPI = None
+
+try:
+    import util
+except ImportError:
+    util = None
+
+class Failure(Exception):
+    pass
+
+# perfmon imports XenAPI at module level, replay only needs the stub below
+stub = types.ModuleType('XenAPI')
+stub.Failure = Failure
+if XenAPI is None:
+    sys.modules['XenAPI'] = stub
+
+# perfmon logs through the SM util module, only found in /opt/xensource/sm
+if util is None:
+    util = types.ModuleType('util')
+    util.SMlog = lambda message: None
+    sys.modules['util'] = util
+
+import perfmon
+import rrdupdates
+
+VM_PARAMS = ['cpu0', 'cpu1', 'memory', 'memory_target', 'memory_internal_free',
+             'vif_0_rx', 'vif_0_tx', 'vbd_xvda_read', 'vbd_xvda_write',
+             'vbd_xvda_iops_read', 'vbd_xvda_iops_write',
+             'vbd_xvda_read_latency', 'vbd_xvda_write_latency']
+
+COUNTERS = ['cpu', 'memory', 'network.rx', 'disk.iops.read']
+
+VMS_FILE = 'vms'
+
+def generate_rrd_updates(vms, rows, step=60, end=None):
+    if end is None:
+        end = int(time.time()) / step * step
+    start = end - (rows - 1) * step
+    legend = []
+    for vm in xrange(vms):
+        uuid = '%08d-0000-0000-0000-000000000000' % vm
+        for param in VM_PARAMS:
+            legend.append('AVERAGE:vm:%s:%s' % (uuid, param))
+
+    xml = ['<xport><meta>']
+    xml.append('<start>%d</start><step>%d</step><end>%d</end>' % (start, step, end))
+    xml.append('<rows>%d</rows><columns>%d</columns><legend>' % (rows, len(legend)))
+    for entry in legend:
+        xml.append('<entry>%s</entry>' % entry)
+    xml.append('</legend></meta><data>')
+    for row in xrange(rows):
+        xml.append('<row><t>%d</t>' % (end - row * step))
+        for col in xrange(len(legend)):
+            xml.append('<v>%.4E</v>' % (((row * 7 + col * 13) % 1000) / 1000.0))
+        xml.append('</row>')
+    xml.append('</data></xport>')
+    return ''.join(xml)
+
+def read_all_minidom(xmlsource):
+    """The DOM walk perfmon.py used before the streaming parser"""
+    xmldoc = minidom.parseString(xmlsource)
+    meta_node = xmldoc.firstChild.childNodes[0]
+    data_node = xmldoc.firstChild.childNodes[1]
+    rows = int(meta_node.getElementsByTagName('rows')[0].firstChild.toxml())
+    columns = int(meta_node.getElementsByTagName('columns')[0].firstChild.toxml())
+    total = 0.0
+    for row in xrange(rows):
+        for col in xrange(columns):
+            node = data_node.childNodes[rows - 1 - row].childNodes[col + 1]
+            total += float(node.firstChild.toxml())
+    return total
+
+
+class Scenario:
+    """The rrd_updates of every host of a pool plus the VM records to resolve names"""
+    def __init__(self, name, payloads, vms):
+        # address -> rrd_updates xml
+        self.name = name
+        self.payloads = payloads
+        # uuid -> (name_label, domid)
+        self.vms = vms
+
+    def size(self):
+        return sum([len(p) for p in self.payloads.values()])
+
+def synthetic_scenario(vms, rows):
+    records = {}
+    for vm in xrange(vms):
+        uuid = '%08d-0000-0000-0000-000000000000' % vm
+        records[uuid] = ('i-2-%d-VM' % vm, str(vm + 1))
+    return Scenario('synthetic %d vms %d rows' % (vms, rows), {'host0': generate_rrd_updates(vms, rows)}, records)
+
+def load_scenario(path):
+    payloads = {}
+    records = {}
+    for name in os.listdir(path):
+        if name.endswith('.xml'):
+            payloads[name[:-len('.xml')]] = open(os.path.join(path, name)).read()
+    vms_path = os.path.join(path, VMS_FILE)
+    if os.path.exists(vms_path):
+        for line in open(vms_path):
+            fields = line.split()
+            if len(fields) == 3:
+                records[fields[0]] = (fields[1], fields[2])
+    if not payloads:
+        raise Exception("no rrd_updates recorded in %s" % path)
+    if not records:
+        # without the VM records the uuids stand for the names
+        for xmlsource in payloads.values():
+            for entry in perfmon.RRDParser().parse(xmlsource).legend:
+                uuid = entry.split(':')[2]
+                records[uuid] = (uuid, '1')
+    return Scenario(path, payloads, records)
+
+
+class StubVM:
+    def __init__(self, scenario):
+        self.scenario = scenario
+
+    def get_all_records_where(self, expr):
+        result = {}
+        for uuid, (name, domid) in self.scenario.vms.items():
+            if ('"%s"' % name) in expr:
+                result['OpaqueRef:' + uuid] = {'uuid': uuid, 'name_label': name, 'domid': domid,
+                                               'is_a_template': False, 'is_a_snapshot': False,
+                                               'is_control_domain': False}
+        return result
+
+class StubHost:
+    def __init__(self, scenario):
+        self.scenario = scenario
+
+    def get_all_records(self):
+        result = {}
+        for address in self.scenario.payloads.keys():
+            result['OpaqueRef:' + address] = {'address': address, 'uuid': address}
+        return result
+
+class StubSessionAPI:
+    def logout(self):
+        pass
+
+class StubXenAPI:
+    def __init__(self, scenario):
+        self.VM = StubVM(scenario)
+        self.host = StubHost(scenario)
+        self.session = StubSessionAPI()
+
+class StubSession:
+    """Stands for XenAPI.xapi_local() and serves the scenario through XenAPI"""
+    def __init__(self, scenario):
+        self.xenapi = StubXenAPI(scenario)
+        self._session = 'OpaqueRef:replay'
+
+    def login_with_password(self, user, password):
+        pass
+
+def install_stub(scenario):
+    stub.xapi_local = lambda: StubSession(scenario)
+    perfmon.XenAPI = stub
+    rrdupdates.fetch = lambda address, path: scenario.payloads[address]
+    rrdupdates.CACHE_TTL = 0
+
+def group_args(scenario, rows, step):
+    names = [name for name, domid in scenario.vms.values()]
+    names.sort()
+    args = {'total_vm': str(len(names)), 'total_counter': str(len(COUNTERS)), 'collector': 'false'}
+    for vm_count in xrange(1, len(names) + 1):
+        args['vmname' + str(vm_count)] = names[vm_count - 1]
+    for counter_count in xrange(1, len(COUNTERS) + 1):
+        args['counter' + str(counter_count)] = COUNTERS[counter_count - 1]
+        args['duration' + str(counter_count)] = str(rows * step)
+    return args
+
+def best_of(fn, repeat):
+    best = None
+    for i in xrange(repeat):
+        begin = time.time()
+        result = fn()
+        elapsed = time.time() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def measure(scenario, repeat, compare_minidom):
+    install_stub(scenario)
+    payloads = scenario.payloads.values()
+    store = perfmon.RRDUpdates()
+
+    def parse():
+        store.load([perfmon.RRDParser().parse(p) for p in payloads])
+    parse_time = best_of(parse, repeat)[0]
+
+    args = group_args(scenario, store.get_nrows(), store.step_time or 60)
+    xenapi = StubXenAPI(scenario)
+
+    def aggregate():
+        perfmon.vm_resolver.cache.clear()
+        return perfmon.group_perfmon(store, xenapi, args)
+    aggregate_time, result = best_of(aggregate, repeat)
+
+    def end_to_end():
+        perfmon.vm_resolver.cache.clear()
+        return perfmon.get_vm_group_perfmon(args)
+    total_time, total_result = best_of(end_to_end, repeat)
+    if total_result != result:
+        print "%s: get_vm_group_perfmon and group_perfmon disagree" % scenario.name
+        return False
+
+    print "%s: %d hosts, %d vms, %d rows, %d bytes" % (scenario.name, len(payloads), len(store.get_vm_list()),
+                                                        store.get_nrows(), scenario.size())
+    print "  parse:       %.3fs" % parse_time
+    print "  aggregate:   %.3fs (%s)" % (aggregate_time, perfmon.numpy and "numpy" or "python")
+    print "  end to end:  %.3fs" % total_time
+    if compare_minidom:
+        minidom_time = best_of(lambda: [read_all_minidom(p) for p in payloads], repeat)[0]
+        print "  minidom:     %.3fs (%.1fx slower parse)" % (minidom_time, minidom_time / max(parse_time, 1e-9))
+    # ru_maxrss is in kilobytes on Linux
+    print "  peak memory: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    return True
+
+def run_isolated(fn, *args):
+    """Runs fn in a child process so that its peak memory is not shared"""
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            if fn(*args):
+                status = 0
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+    return os.waitpid(pid, 0)[1] == 0
+
+def record(path, url, user, password):
+    if XenAPI is None:
+        print "record needs the XenAPI module"
+        return False
+    session = XenAPI.Session(url)
+    session.xenapi.login_with_password(user, password)
+    try:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        hosts = {}
+        for host_rec in session.xenapi.host.get_all_records().values():
+            hosts[str(host_rec['address'])] = host_rec['name_label']
+
+        fetch = rrdupdates.fetch
+        def recording_fetch(address, query):
+            xmlsource = fetch(address, query)
+            f = open(os.path.join(path, address + '.xml'), 'w')
+            try:
+                f.write(xmlsource)
+            finally:
+                f.close()
+            return xmlsource
+        rrdupdates.fetch = recording_fetch
+        rrd_updates = perfmon.RRDUpdates()
+        rrd_updates.refresh(session.xenapi, int(time.time()) - 3600, session._session, {}, 0)
+
+        f = open(os.path.join(path, VMS_FILE), 'w')
+        try:
+            for rec in session.xenapi.VM.get_all_records().values():
+                if rec['uuid'] in rrd_updates.vm_reports:
+                    f.write("%s %s %s\n" % (rec['uuid'], rec['name_label'].replace(' ', '_'), rec['domid']))
+        finally:
+            f.close()
+        print "recorded %d hosts, %d vms, %d rows into %s" % (len(hosts), len(rrd_updates.get_vm_list()),
+                                                              rrd_updates.get_nrows(), path)
+        return True
+    finally:
+        session.xenapi.session.logout()
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog synthetic|record|replay [DIR...] [options]")
+    parser.add_option("--vms", dest="vms", default="10,100,500",
+                      help="comma separated VM counts of the synthetic payloads")
+    parser.add_option("--rows", dest="rows", type="int", default=60,
+                      help="rows of the synthetic payloads")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="runs of which the best time is reported")
+    parser.add_option("--no-numpy", dest="numpy", action="store_false", default=True,
+                      help="use the pure python aggregation")
+    parser.add_option("--minidom", dest="minidom", action="store_true", default=False,
+                      help="also time the legacy minidom parse")
+    parser.add_option("--url", dest="url", default="http://localhost",
+                      help="pool master to record from")
+    parser.add_option("--user", dest="user", default="root")
+    parser.add_option("--password", dest="password", default="")
+    (options, args) = parser.parse_args()
+    if not args or args[0] not in ('synthetic', 'record', 'replay'):
+        parser.print_usage()
+        sys.exit(1)
+    if not options.numpy:
+        perfmon.numpy = None
+
+    ok = True
+    if args[0] == 'record':
+        if len(args) != 2:
+            parser.print_usage()
+            sys.exit(1)
+        ok = record(args[1], options.url, options.user, options.password)
+    elif args[0] == 'replay':
+        for path in args[1:]:
+            ok = run_isolated(measure, load_scenario(path), options.repeat, options.minidom) and ok
+    else:
+        for vms in [int(v) for v in options.vms.split(',')]:
+            ok = run_isolated(measure, synthetic_scenario(vms, options.rows), options.repeat, options.minidom) and ok
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Version @VERSION@
+#
+# Long running collector answering the autoscale asmonitor queries of
+# vmopspremium from memory.  Every interval it fetches only the rrd_updates
+# rows added since the previous fetch and appends them to a rolling window
+# of history per VM and variable.  perfmon.get_vm_group_perfmon starts it on
+# demand and queries it over a unix socket.
+#
+# usage: perfmond.py start|stop|run [--history seconds] [--interval seconds]
+
+import os, sys, time
+# installed next to perfmon.py and util.py, /opt/xensource/sm or /usr/lib/xcp/sm
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("/opt/xensource/sm/")
+import cgi
+import errno
+import fcntl
+import signal
+import socket
+import SocketServer
+import threading
+import traceback
+import XenAPI
+import perfmon
+import util
+
+PID_FILE = '/var/run/perfmond.pid'
+
+class Collector:
+    def __init__(self, history, interval):
+        self.history = history
+        self.interval = interval
+        self.max_rows = history / interval
+        self.store = perfmon.RRDUpdates()
+        self.cursor = None
+        # uuids of the VMs reported by the latest fetch
+        self.live = {}
+        self.login = None
+        self.lock = threading.Lock()
+
+    def get_session(self):
+        if self.login is None:
+            login = XenAPI.xapi_local()
+            login.login_with_password("", "")
+            self.login = login
+        return self.login
+
+    def collect(self):
+        if self.cursor is None:
+            self.cursor = int(time.time()) - self.history
+        login = self.get_session()
+        batch = perfmon.RRDUpdates()
+        try:
+            # every fetch asks for a new window, nothing to share through the cache
+            batch.refresh(login.xenapi, self.cursor, login._session, {}, 0)
+        except XenAPI.Failure:
+            # the session went away, e.g. xapi was restarted
+            self.login = None
+            raise
+        self.lock.acquire()
+        try:
+            self.store.extend(batch, self.max_rows)
+            self.live = dict.fromkeys(batch.vm_reports.keys())
+        finally:
+            self.lock.release()
+        # start=end_time+1, avoid retrieving same data twice
+        self.cursor = batch.params['start']
+
+    def query(self, args):
+        max_duration = perfmon.get_max_duration(args)
+        xenapi = self.get_session().xenapi
+        try:
+            # the XenAPI lookup of uncached names must not block collect(),
+            # query_perfmon below then only hits the resolver cache.  Names
+            # cached for a uuid missing from the latest fetch are looked up
+            # again, the VM may have been recreated
+            perfmon.vm_resolver.resolve(xenapi, query_names(args), self.live)
+        except (perfmon.PerfMonException, KeyError, ValueError):
+            # reported by query_perfmon, per group for a batch
+            pass
+        self.lock.acquire()
+        try:
+            covered = self.store.get_nrows() * self.store.step_time
+            if covered < max_duration:
+                raise perfmon.PerfMonException("only %s of %s seconds collected" % (covered, max_duration))
+            # collect() keeps failing, e.g. xapi is restarting
+            age = int(time.time()) - self.store.end_time
+            if age > 2 * max(self.interval, self.store.step_time):
+                raise perfmon.PerfMonException("last samples collected %s seconds ago" % age)
+            return perfmon.query_perfmon(self.store, xenapi, args)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            begin = time.time()
+            try:
+                self.collect()
+            except Exception:
+                util.SMlog("perfmond: failed to collect rrd_updates: %s" % traceback.format_exc())
+            time.sleep(max(1, self.interval - (time.time() - begin)))
+
+
+def query_names(args):
+    """Returns the VM names of a group or batched query"""
+    if 'total_group' in args:
+        groups = perfmon.split_groups(args)
+    else:
+        groups = [args]
+    names = []
+    for group in groups:
+        names.extend([group['vmname' + str(vm_count)] for vm_count in xrange(1, int(group['total_vm']) + 1)])
+    return names
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline().strip()
+        args = {}
+        for key, value in cgi.parse_qsl(line, True):
+            args[key] = value
+        try:
+            reply = self.server.collector.query(args)
+        except Exception, e:
+            reply = "ERROR: %s" % str(e)
+        self.wfile.write(reply)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, collector):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, QueryHandler)
+        os.chmod(path, 0600)
+        self.collector = collector
+
+
+def lock_pidfile():
+    """Returns the locked pid file, or None when another collector holds it"""
+    fd = os.open(PID_FILE, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return None
+        raise
+    os.ftruncate(fd, 0)
+    os.write(fd, "%d\n" % os.getpid())
+    return fd
+
+def daemonize():
+    if os.fork() > 0:
+        # let the caller wait for the first child only
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    os.chdir("/")
+    os.umask(022)
+    null = os.open("/dev/null", os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+
+def run(history, interval):
+    fd = lock_pidfile()
+    if fd is None:
+        return
+    sockdir = os.path.dirname(perfmon.COLLECTOR_SOCKET)
+    if not os.path.exists(sockdir):
+        os.makedirs(sockdir)
+    collector = Collector(history, interval)
+    server = QueryServer(perfmon.COLLECTOR_SOCKET, collector)
+    t = threading.Thread(target=collector.run)
+    t.setDaemon(True)
+    t.start()
+    util.SMlog("perfmond: started, history=%ss interval=%ss" % (history, interval))
+    server.serve_forever()
+
+def stop():
+    try:
+        pid = int(open(PID_FILE).read().strip())
+        os.kill(pid, signal.SIGTERM)
+    except (IOError, OSError, ValueError):
+        pass
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog start|stop|run [options]")
+    parser.add_option("--history", dest="history", type="int", default=3600,
+                      help="seconds of samples kept in memory")
+    parser.add_option("--interval", dest="interval", type="int", default=60,
+                      help="seconds between two rrd_updates fetches")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ('start', 'stop', 'run'):
+        parser.print_usage()
+        sys.exit(1)
+
+    if args[0] == 'stop':
+        stop()
+    elif args[0] == 'start':
+        daemonize()
+        run(options.history, options.interval)
+    else:
+        run(options.history, options.interval)
+
+if __name__ == "__main__":
+    main()
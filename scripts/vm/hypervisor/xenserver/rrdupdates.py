@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Version @VERSION@
+#
+# Fetching and parsing of the xapi rrd_updates document, shared by
+# hostvmstats.py and perfmon.py.  Connections to xapi are kept alive and
+# reused, and fetched documents are cached on disk for a few seconds so
+# that calls asking for the same window in the same polling cycle only
+# fetch it once.
+
+import array
+import httplib
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib
+from xml.parsers import expat
+
+# Seconds a fetched document is served from the cache, 0 disables it
+CACHE_TTL = 15
+CACHE_DIR = '/var/run/cloud/rrd_updates'
+
+INVENTORY = '/etc/xensource-inventory'
+
+
+class RRDException(Exception):
+    pass
+
+
+class RRDParser:
+    """Streaming parser for the XML document returned by rrd_updates
+
+    The document is decoded in a single pass with expat.  Each <v> sample is
+    converted to a float as soon as it is read and appended to a compact
+    per-column array, so no DOM tree is ever built.
+    """
+    def __init__(self):
+        self.start_time = 0
+        self.step_time = 0
+        self.end_time = 0
+        self.rows = 0
+        self.columns = 0
+        # legend entries, e.g. 'AVERAGE:vm:<uuid>:cpu0', one per column
+        self.legend = []
+        # timestamps and columns are stored in chronological order
+        self.timestamps = array.array('l')
+        self.data = []
+
+    def parse(self, xmlsource):
+        meta = {}
+        legend = self.legend
+        timestamps = self.timestamps
+        data = self.data
+        text = []
+        state = {'col': 0}
+
+        def start_element(name, attrs):
+            del text[:]
+            if name == 'row':
+                state['col'] = 0
+            elif name == 'data':
+                for col in xrange(len(legend)):
+                    data.append(array.array('d'))
+
+        def end_element(name):
+            if name == 'v':
+                col = state['col']
+                data[col].append(float(''.join(text)))
+                state['col'] = col + 1
+            elif name == 't':
+                timestamps.append(int(''.join(text)))
+            elif name == 'entry':
+                legend.append(''.join(text))
+            elif name in ('start', 'step', 'end', 'rows', 'columns'):
+                meta[name] = int(''.join(text))
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = text.append
+        try:
+            parser.Parse(xmlsource, True)
+        except expat.ExpatError, e:
+            raise RRDException("Failed to parse rrd_updates: %s" % str(e))
+
+        # The <row> nodes are in reverse chronological order
+        timestamps.reverse()
+        for column in data:
+            column.reverse()
+
+        self.start_time = meta.get('start', 0)
+        self.step_time = meta.get('step', 0)
+        self.end_time = meta.get('end', 0)
+        self.rows = len(timestamps)
+        self.columns = len(legend)
+        if meta.get('columns', self.columns) != self.columns:
+            raise RRDException("Expected %s columns in <legend>, found %s" % (meta['columns'], self.columns))
+        return self
+
+
+class ConnectionPool:
+    """Idle keep-alive HTTP connections per address
+
+    A connection is taken out of the pool for the duration of a request, so
+    concurrent requests to the same address each get their own.
+    """
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, address):
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(address)
+            if connections:
+                return connections.pop()
+        finally:
+            self.lock.release()
+        return httplib.HTTPConnection(address)
+
+    def put(self, address, conn):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(address, []).append(conn)
+        finally:
+            self.lock.release()
+
+pool = ConnectionPool()
+
+def request(conn, path):
+    conn.request('GET', path)
+    response = conn.getresponse()
+    return response.status, response.reason, response.read()
+
+def fetch(address, path):
+    """GETs path from the xapi of address over a kept-alive connection"""
+    conn = pool.get(address)
+    try:
+        try:
+            (status, reason, body) = request(conn, path)
+        except (httplib.HTTPException, socket.error):
+            # xapi may have closed the idle connection meanwhile
+            conn.close()
+            conn = httplib.HTTPConnection(address)
+            (status, reason, body) = request(conn, path)
+    except:
+        conn.close()
+        raise
+    if status != 200:
+        conn.close()
+        # like urllib.URLopener, rather than parsing an error page
+        raise IOError('http error', status, reason)
+    pool.put(address, conn)
+    return body
+
+def cache_path(address, start, interval, cf, host):
+    return os.path.join(CACHE_DIR, "%s_%s_%s_%s_%s.xml" % (address, start, interval, cf, host))
+
+def cache_load(path, ttl):
+    try:
+        if time.time() - os.stat(path).st_mtime > ttl:
+            return None
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+def cache_store(path, xmlsource, ttl):
+    """Atomically stores a document and drops the expired ones, best effort"""
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        (fd, tmp) = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(xmlsource)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        now = time.time()
+        for name in os.listdir(CACHE_DIR):
+            old = os.path.join(CACHE_DIR, name)
+            if now - os.stat(old).st_mtime > 4 * ttl:
+                os.remove(old)
+    except (IOError, OSError):
+        pass
+
+def local_host_uuid():
+    """The uuid of this host as recorded in the xensource inventory, or None"""
+    try:
+        for line in open(INVENTORY):
+            if line.startswith('INSTALLATION_UUID='):
+                return line.split('=', 1)[1].strip().strip("'")
+    except IOError:
+        pass
+    return None
+
+def get(address, session_id, start, interval=60, cf='AVERAGE', host=False, ttl=None):
+    """Returns the rrd_updates document of the host at address
+
+    Documents are shared through the cache for ttl seconds (CACHE_TTL by
+    default) under (address, start, interval, cf, host); callers wanting to
+    share one should align start, e.g. on interval.
+    """
+    if ttl is None:
+        ttl = CACHE_TTL
+    host = str(host).lower()
+    path = None
+    if ttl > 0:
+        path = cache_path(address, start, interval, cf, host)
+        xmlsource = cache_load(path, ttl)
+        if xmlsource is not None:
+            return xmlsource
+
+    query = urllib.urlencode([('session_id', session_id), ('start', start), ('interval', interval),
+                              ('cf', cf), ('host', host)])
+    xmlsource = fetch(address, '/rrd_updates?' + query)
+    if path is not None:
+        cache_store(path, xmlsource, ttl)
+    return xmlsource
+
+def parse(xmlsource):
+    return RRDParser().parse(xmlsource)
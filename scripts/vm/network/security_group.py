@@ -25,17 +25,252 @@ import os
 import xml.dom.minidom
 from optparse import OptionParser, OptionGroup, OptParseError, BadOptionError, OptionError, OptionConflictError, OptionValueError
 import re
+import hashlib
+import json
+import socket
+import SocketServer
+import StringIO
+import subprocess
+import threading
 import traceback
+import zlib
+import base64
 import libvirt
 
 logpath = "/var/run/cloud/"        # FIXME: Logs should reside in /var/log/cloud
+daemon_socket = "/var/run/cloud/security_group.sock"
+# seconds a command waits for the daemon before running in-process
+daemon_timeout = 120
 iptables = Command("iptables")
 bash = Command("/bin/bash")
 ebtablessave = Command("ebtables-save")
 ebtables = Command("ebtables")
 def execute(cmd):
     logging.debug(cmd)
-    return bash("-c", cmd).stdout
+    out = bash("-c", cmd).stdout
+    note_write(cmd)
+    return out
+
+def restore(cmd, text):
+    """Runs cmd, e.g. iptables-restore, with text on its standard input"""
+    logging.debug(cmd + "\n" + text)
+    proc = subprocess.Popen(["/bin/bash", "-c", cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = proc.communicate(text)
+    invalidate_snapshots()
+    if proc.returncode:
+        logging.debug(cmd + " failed: " + err)
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return out
+
+class RuleTransaction:
+    """Programs the rules of a VM with a single iptables-restore or ebtables-restore
+
+    chain() declares a chain that is created, or flushed when it already
+    exists, and flushes it again at that point when declared twice; add()
+    queues a rule such as '-A chain ...' or '-D chain ...'.
+    commit() applies everything atomically with --noflush, and falls back
+    to one command per rule when the restore tool refuses the transaction,
+    e.g. an ebtables-restore without --noflush.
+    """
+    def __init__(self, tool, table):
+        self.tool = tool
+        self.table = table
+        self.chains = []
+        self.rules = []
+
+    def chain(self, name):
+        if name not in self.chains:
+            self.chains.append(name)
+        else:
+            self.rules.append("-F " + name)
+
+    def add(self, rule):
+        self.rules.append(rule)
+
+    def text(self):
+        lines = ["*" + self.table]
+        for chain in self.chains:
+            if self.tool == "iptables":
+                lines.append(":" + chain + " - [0:0]")
+            else:
+                lines.append(":" + chain + " ACCEPT")
+        lines += self.rules
+        if self.tool == "iptables":
+            lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def commit(self):
+        if not self.chains and not self.rules:
+            return
+        try:
+            restore(self.tool + "-restore --noflush", self.text())
+            return
+        except:
+            logging.debug(self.tool + "-restore failed, programming the rules one by one")
+
+        cmd = self.tool + " -t " + self.table + " "
+        for chain in self.chains:
+            try:
+                execute(cmd + "-N " + chain)
+            except:
+                execute(cmd + "-F " + chain)
+        for rule in self.rules:
+            if rule.startswith("-D "):
+                try:
+                    execute(cmd + rule)
+                except:
+                    logging.debug("Ignoring failure to delete rule: " + rule)
+            else:
+                execute(cmd + rule)
+
+class IpsetTransaction:
+    """Programs a batch of ipset commands with a single 'ipset -R'
+
+    Commands are given without the leading 'ipset', e.g. '-A set 10.0.0.0/8'.
+    When the batch is refused the commands are run one by one, flushing the
+    sets that already exist and ignoring the ones that cannot be destroyed.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def add(self, command):
+        self.commands.append(command)
+
+    def commit(self):
+        if not self.commands:
+            return
+        try:
+            restore("ipset -R", "\n".join(self.commands) + "\n")
+            return
+        except:
+            logging.debug("ipset -R failed, programming the sets one by one")
+
+        for command in self.commands:
+            if command.startswith("-N "):
+                try:
+                    execute("ipset " + command)
+                except:
+                    execute("ipset -F " + command.split()[1])
+            elif command.startswith("-X "):
+                try:
+                    execute("ipset " + command)
+                except:
+                    logging.debug("Ignoring failure to destroy ipset: " + command)
+            else:
+                execute("ipset " + command)
+
+class RuleIndex:
+    """Parsed output of iptables-save or ebtables-save
+
+    Rules are kept as the '-A chain ...' lines of the save output, per table
+    and per chain, and indexed by the chain they jump to.
+    """
+    def __init__(self, text):
+        self.chains = {}
+        self.rules = {}
+        self.jumps = {}
+        table = None
+        for line in text.split('\n'):
+            line = line.strip()
+            if line.startswith('*'):
+                table = line[1:]
+                self.chains.setdefault(table, [])
+                self.rules.setdefault(table, [])
+            elif table == None:
+                continue
+            elif line.startswith(':'):
+                self.chains[table].append(line[1:].split()[0])
+            elif line.startswith('-A '):
+                self.add_rule(table, line)
+
+    def add_rule(self, table, line):
+        self.rules[table].append(line)
+        tokens = line.split()
+        if '-j' in tokens and tokens.index('-j') + 1 < len(tokens):
+            target = tokens[tokens.index('-j') + 1]
+            self.jumps.setdefault(target, []).append((table, line))
+
+    def remove_rule(self, table, line):
+        """Forgets a rule, returns False when it is not known as such"""
+        if line not in self.rules.get(table, []):
+            return False
+        self.rules[table].remove(line)
+        for target in self.jumps.keys():
+            if (table, line) in self.jumps[target]:
+                self.jumps[target].remove((table, line))
+        return True
+
+    def has_chain(self, chain, table='filter'):
+        return chain in self.chains.get(table, [])
+
+    def all_chains(self):
+        chains = []
+        for table in self.chains.keys():
+            for chain in self.chains[table]:
+                if chain not in chains:
+                    chains.append(chain)
+        return chains
+
+    def chain_rules(self, chain, table='filter'):
+        prefix = '-A ' + chain + ' '
+        return [line for line in self.rules.get(table, []) if line.startswith(prefix)]
+
+    def table_rules(self, table='filter'):
+        return list(self.rules.get(table, []))
+
+    def references(self, chain, table='filter'):
+        """The rules jumping to chain"""
+        return [line for (t, line) in self.jumps.get(chain, []) if t == table]
+
+    def apply(self, table, args):
+        """Mirrors a successful write in the index, returns False when it cannot"""
+        if len(args) < 2:
+            return False
+        (op, chain) = (args[0], args[1])
+        if op == '-D' and len(args) > 2:
+            return self.remove_rule(table, ' '.join(['-A'] + args[1:]))
+        elif op == '-F':
+            for line in self.chain_rules(chain, table):
+                self.remove_rule(table, line)
+            return True
+        elif op == '-X':
+            if chain in self.chains.get(table, []):
+                self.chains[table].remove(chain)
+            return True
+        elif op == '-N':
+            self.chains.setdefault(table, []).append(chain)
+            self.rules.setdefault(table, [])
+            return True
+        # rules added are only known in the form the save output gives them
+        return False
+
+# RuleIndex per tool, taken once per command and kept up to date by execute
+snapshots = {}
+
+def rule_index(tool):
+    """Returns the RuleIndex of 'iptables' or 'ebtables', running tool-save once"""
+    if tool not in snapshots:
+        snapshots[tool] = RuleIndex(execute(tool + "-save"))
+    return snapshots[tool]
+
+def invalidate_snapshots():
+    snapshots.clear()
+
+def note_write(cmd):
+    """Keeps the snapshots in line with a command run through execute"""
+    tokens = cmd.split()
+    if not tokens or tokens[0] not in ['iptables', 'ebtables'] or tokens[0] not in snapshots:
+        return
+    if '|' in tokens or '-L' in tokens or '-S' in tokens:
+        return
+    args = tokens[1:]
+    table = 'filter'
+    if args[:1] == ['-t'] and len(args) > 1:
+        table = args[1]
+        args = args[2:]
+    if not snapshots[tokens[0]].apply(table, args):
+        del snapshots[tokens[0]]
+
 def can_bridge_firewall(privnic):
     try:
         execute("which iptables")
@@ -83,6 +318,48 @@ def ipset(ipsetname, proto, start, end, ips):
 
     return result
 '''
+# libvirt connection shared by every call of this process, see get_connection
+conn = None
+# parsed domain xml per vm name for the current command, see get_domain_info
+domain_infos = {}
+
+def get_connection():
+    global conn
+    if conn == None:
+        conn = libvirt.openReadOnly('qemu:///system')
+        if conn == None:
+           print 'Failed to open connection to the hypervisor'
+           sys.exit(3)
+    return conn
+
+def reset_connection():
+    """Drops the shared connection, e.g. after libvirtd was restarted"""
+    global conn
+    if conn != None:
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+    conn = None
+    domain_infos.clear()
+
+def call_libvirt(fn):
+    """Returns fn(conn) on the shared connection, retried on a new connection
+    when the shared one went stale, e.g. after libvirtd was restarted"""
+    try:
+        return fn(get_connection())
+    except libvirt.libvirtError, e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            raise
+        reset_connection()
+    return fn(get_connection())
+
+def lookup_domain(domain):
+    try:
+        return call_libvirt(lambda conn: conn.lookupByName(domain))
+    except libvirt.libvirtError:
+        return None
+
 def virshlist(*states):
 
     libvirt_states={ 'running'  : libvirt.VIR_DOMAIN_RUNNING,
@@ -96,22 +373,17 @@ def virshlist(*states):
 
     searchstates = list(libvirt_states[state] for state in states)
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    alldomains = map(conn.lookupByID, conn.listDomainsID())
-    alldomains += map(conn.lookupByName, conn.listDefinedDomains())
+    def list_domains(conn):
+        alldomains = map(conn.lookupByID, conn.listDomainsID())
+        alldomains += map(conn.lookupByName, conn.listDefinedDomains())
 
-    domains = []
-    for domain in alldomains:
-        if domain.info()[0] in searchstates:
-            domains.append(domain.name())
+        domains = []
+        for domain in alldomains:
+            if domain.info()[0] in searchstates:
+                domains.append(domain.name())
+        return domains
 
-    conn.close()
-
-    return domains
+    return call_libvirt(list_domains)
 
 def virshdomstate(domain):
 
@@ -124,37 +396,19 @@ def virshdomstate(domain):
                      libvirt.VIR_DOMAIN_CRASHED  : 'crashed',
     }
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    try:
-        dom = (conn.lookupByName (domain))
-    except libvirt.libvirtError:
+    dom = lookup_domain(domain)
+    if dom == None:
         return None
 
-    state = libvirt_states[dom.info()[0]]
-    conn.close()
-
-    return state
+    return libvirt_states[dom.info()[0]]
 
 def virshdumpxml(domain):
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    try:
-        dom = (conn.lookupByName (domain))
-    except libvirt.libvirtError:
+    dom = lookup_domain(domain)
+    if dom == None:
         return None
 
-    xml = dom.XMLDesc(0)
-    conn.close()
-
-    return xml
+    return dom.XMLDesc(0)
 
 def destroy_network_rules_for_vm(vm_name, vif=None):
     vmchain = vm_name
@@ -206,9 +460,11 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
     except:
         logging.debug("Ignoring failure to delete ipset " + vmchain)
 
+    destroy_rule_ipsets(vm_name)
+
     if vif is not None:
         try:
-            dnats = execute("""iptables -t nat -S | awk '/%s/ { sub(/-A/, "-D", $1) ; print }'""" % vif ).split("\n")
+            dnats = ["-D" + line[2:] for line in rule_index('iptables').table_rules('nat') if vif in line]
             for dnat in dnats:
                 try:
                     execute("iptables -t nat " + dnat)
@@ -224,26 +480,21 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
 
     return 'true'
 
-def destroy_ebtables_rules(vm_name, vif):
-
-    delcmd = "ebtables -t nat -L PREROUTING | grep " + vm_name
+def ebtables_rules_to_vm(vm_name):
+    """Returns the '-D' commands of the PREROUTING/POSTROUTING jumps to the chains of a vm"""
     delcmds = []
     try:
-        delcmds = execute(delcmd).split('\n')
-        delcmds.pop()
-        delcmds = ["-D PREROUTING " + x for x in delcmds ]
-    except:
-        pass
-    postcmds = []
-    try:
-        postcmd = "ebtables -t nat -L POSTROUTING | grep " + vm_name
-        postcmds = execute(postcmd).split('\n')
-        postcmds.pop()
-        postcmds = ["-D POSTROUTING " + x for x in postcmds]
+        index = rule_index('ebtables')
+        for chain in ['PREROUTING', 'POSTROUTING']:
+            delcmds += ["-D" + line[2:] for line in index.chain_rules(chain, 'nat') if vm_name in line]
     except:
         pass
 
-    delcmds += postcmds
+    return delcmds
+
+def destroy_ebtables_rules(vm_name, vif):
+
+    delcmds = ebtables_rules_to_vm(vm_name)
 
     for cmd in delcmds:
         try:
@@ -258,52 +509,53 @@ def destroy_ebtables_rules(vm_name, vif):
         except:
             logging.debug("Ignoring failure to delete ebtables chain for vm " + vm_name)
 
-def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif):
+def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif, sec_ips=[], ebt=None):
     vmchain_in = vm_name + "-in"
     vmchain_out = vm_name + "-out"
     vmchain_in_ips = vm_name + "-in-ips"
     vmchain_out_ips = vm_name + "-out-ips"
 
+    commit = ebt is None
+    if commit:
+        ebt = RuleTransaction("ebtables", "nat")
+    # the chains are flushed below, only the jumps to them need removing
+    for cmd in ebtables_rules_to_vm(vm_name):
+        ebt.add(cmd)
     for chain in [vmchain_in, vmchain_out, vmchain_in_ips, vmchain_out_ips]:
-        try:
-            execute("ebtables -t nat -N " + chain)
-        except:
-            execute("ebtables -t nat -F " + chain)
+        ebt.chain(chain)
 
-    try:
-        # -s ! 52:54:0:56:44:32 -j DROP
-        execute("ebtables -t nat -A PREROUTING -i " + vif + " -j " + vmchain_in)
-        execute("ebtables -t nat -A POSTROUTING -o " + vif + " -j " + vmchain_out)
-        execute("ebtables -t nat -A " + vmchain_in_ips + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_out_ips + " -j DROP")
-    except:
-        logging.debug("Failed to program default rules")
-        return 'false'
+    # -s ! 52:54:0:56:44:32 -j DROP
+    ebt.add("-A PREROUTING -i " + vif + " -j " + vmchain_in)
+    ebt.add("-A POSTROUTING -o " + vif + " -j " + vmchain_out)
+    ebt.add("-A " + vmchain_in_ips + " -j DROP")
+    ebt.add("-A " + vmchain_out_ips + " -j DROP")
 
-    try:
-        execute("ebtables -t nat -A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
-        if vm_ip is not None:
-            execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
-            execute("ebtables -t nat -I " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j DROP")
-    except:
-        logging.exception("Failed to program default ebtables IN rules")
-        return 'false'
+    ebt.add("-A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
+    ebt.add("-A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
+    ebt.add("-A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
+    if vm_ip is not None:
+        ebt.add("-A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
+        ebt.add("-I " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
+    ebt.add("-A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
+    ebt.add("-A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
+    ebt.add("-A " + vmchain_in + " -p ARP -j DROP")
+
+    ebt.add("-A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
+    if vm_ip is not None:
+        ebt.add("-A " + vmchain_out + " -p ARP -j " + vmchain_out_ips )
+        ebt.add("-I " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
+    ebt.add("-A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
+    ebt.add("-A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
+    ebt.add("-A " + vmchain_out + " -p ARP -j DROP")
+
+    ebtables_rules_vmip(vm_name, sec_ips, "-I", ebt)
+    if not commit:
+        return
 
     try:
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
-        if vm_ip is not None:
-            execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j " + vmchain_out_ips )
-            execute("ebtables -t nat -I " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j DROP")
+        ebt.commit()
     except:
-        logging.debug("Failed to program default ebtables OUT rules")
+        logging.exception("Failed to program default ebtables rules")
         return 'false'
 
 
@@ -312,12 +564,10 @@ def default_network_rules_systemvm(vm_name, localbrname):
     domid = getvmId(vm_name)
     vmchain = vm_name
 
-    delete_rules_for_vm_in_bridge_firewall_chain(vm_name)
-
-    try:
-        execute("iptables -N " + vmchain)
-    except:
-        execute("iptables -F " + vmchain)
+    ipt = RuleTransaction("iptables", "filter")
+    for cmd in bridge_firewall_rules_for_vm(vm_name):
+        ipt.add(cmd)
+    ipt.chain(vmchain)
 
     for bridge in bridges:
         if bridge != localbrname:
@@ -326,15 +576,16 @@ def default_network_rules_systemvm(vm_name, localbrname):
             brfw = getBrfw(bridge)
             vifs = getVifsForBridge(vm_name, bridge)
             for vif in vifs:
-                try:
-                    execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-                    execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain)
-                    execute("iptables -A " + vmchain + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j RETURN")
-                except:
-                    logging.debug("Failed to program default rules")
-                    return 'false'
+                ipt.add("-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
+                ipt.add("-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain)
+                ipt.add("-A " + vmchain + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j RETURN")
 
-    execute("iptables -A " + vmchain + " -j ACCEPT")
+    ipt.add("-A " + vmchain + " -j ACCEPT")
+    try:
+        ipt.commit()
+    except:
+        logging.debug("Failed to program default rules")
+        return 'false'
 
     if write_rule_log_for_vm(vm_name, '-1', '_ignore_', domid, '_initial_', '-1') == False:
         logging.debug("Failed to log default network rules for systemvm, ignoring")
@@ -372,18 +623,60 @@ def write_secip_log_for_vm (vmName, secIps, vmId):
 
     return result
 
-def create_ipset_forvm (ipsetname):
-    result = True
+def ipset_names():
     try:
-        logging.debug("Creating ipset chain .... " + ipsetname)
-        execute("ipset -F " + ipsetname)
-        execute("ipset -X " + ipsetname)
-        execute("ipset -N " + ipsetname + " iphash")
+        return execute("ipset -L -n").split()
     except:
-        logging.debug("ipset chain not exists creating.... " + ipsetname)
-        execute("ipset -N " + ipsetname + " iphash")
-
-    return result
+        return []
+
+def rule_ipset_prefix(vm_name):
+    # ipset names are limited to 31 characters, the hash of the whole name
+    # keeps vms whose names share a long prefix apart
+    return "sg_" + hashlib.md5(vm_name).hexdigest()[:12] + "_"
+
+def rule_ipset_name(vm_name, key):
+    return rule_ipset_prefix(vm_name) + hashlib.md5(vm_name + ":" + key).hexdigest()[:12]
+
+def program_rule_ipset(ipst, existing, ipsetname, ips, settype="nethash"):
+    """Queues the swap of the content of a set, hash:net by default, to ips
+
+    The new content is filled in a temporary set swapped with the live one,
+    so rules matching the set never see it partially filled.
+    """
+    ipsettmp = ipsetname + "t"
+    if ipsetname not in existing:
+        ipst.add("-N " + ipsetname + " " + settype)
+    if ipsettmp in existing:
+        ipst.add("-X " + ipsettmp)
+    ipst.add("-N " + ipsettmp + " " + settype)
+    seen = {}
+    for ip in ips:
+        if ip not in seen:
+            seen[ip] = True
+            ipst.add("-A " + ipsettmp + " " + ip)
+    ipst.add("-W " + ipsettmp + " " + ipsetname)
+    ipst.add("-X " + ipsettmp)
+
+def destroy_rule_ipsets(vm_name, keep=[], existing=None, ipst=None):
+    """Destroys the rule ipsets of a vm not in keep, once no rule refers to them
+
+    With ipst the commands are only queued there.
+    """
+    if existing is None:
+        existing = ipset_names()
+    prefix = rule_ipset_prefix(vm_name)
+    commit = ipst is None
+    if commit:
+        ipst = IpsetTransaction()
+    for name in existing:
+        if name.startswith(prefix) and name not in keep:
+            ipst.add("-X " + name)
+    if not commit:
+        return
+    try:
+        ipst.commit()
+    except:
+        logging.debug("Ignoring failure to destroy the rule ipsets of " + vm_name)
 
 def add_to_ipset(ipsetname, ips, action):
     result = True
@@ -411,10 +704,17 @@ def network_rules_vmSecondaryIp(vm_name, ip_secondary, action):
 
     return 'true'
 
-def ebtables_rules_vmip (vmname, ips, action):
+def ebtables_rules_vmip (vmname, ips, action, ebt=None):
     vmchain_inips = vmname + "-in-ips"
     vmchain_outips = vmname + "-out-ips"
 
+    if ebt is not None:
+        # part of a larger transaction, committed by the caller
+        for ip in ips:
+            ebt.add("-I " + vmchain_inips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
+            ebt.add("-I " + vmchain_outips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
+        return
+
     for ip in ips:
         logging.debug("ip = "+ip)
         try:
@@ -424,81 +724,82 @@ def ebtables_rules_vmip (vmname, ips, action):
             logging.debug("Failed to program ebtables rules for secondary ip "+ ip)
         continue
 
-def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
+def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips, batch=None):
     if not addFWFramework(brname):
         return False
 
     vmName = vm_name
     brfw = getBrfw(brname)
     domID = getvmId(vm_name)
-    delete_rules_for_vm_in_bridge_firewall_chain(vmName)
     vmchain = vm_name
     vmchain_egress = egress_chain_name(vm_name)
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
 
-    destroy_ebtables_rules(vmName, vif)
-
-    try:
-        execute("iptables -N " + vmchain)
-    except:
-        execute("iptables -F " + vmchain)
-
-    try:
-        execute("iptables -N " + vmchain_egress)
-    except:
-        execute("iptables -F " + vmchain_egress)
-
-    try:
-        execute("iptables -N " + vmchain_default)
-    except:
-        execute("iptables -F " + vmchain_default)
+    # a batch commits the rules of all its vms at once
+    if batch == None:
+        ipt = RuleTransaction("iptables", "filter")
+        ipst = IpsetTransaction()
+        existing = ipset_names()
+    else:
+        ipt = batch.ipt
+        ipst = batch.ipst
+        existing = batch.ipset_names()
+    for cmd in bridge_firewall_rules_for_vm(vmName):
+        ipt.add(cmd)
+    ipt.chain(vmchain)
+    ipt.chain(vmchain_egress)
+    ipt.chain(vmchain_default)
 
-    action = "-A"
     vmipsetName = vm_name
-    #create ipset and add vm ips to that ip set
-    if create_ipset_forvm(vmipsetName) == False:
-       logging.debug(" failed to create ipset for rule " + str(tokens))
-       return 'false'
-
-    #add primary nic ip to ipset
-    if add_to_ipset(vmipsetName, [vm_ip], action ) == False:
-       logging.debug(" failed to add vm " + vm_ip + " ip to set ")
-       return 'false'
-
-    #add secodnary nic ips to ipset
     secIpSet = "1"
     ips = sec_ips.split(':')
     ips.pop()
     if ips[0] == "0":
         secIpSet = "0";
+        ips = []
 
-    if secIpSet == "1":
-        logging.debug("Adding ipset for secondary ips")
-        add_to_ipset(vmipsetName, ips, action)
-        if write_secip_log_for_vm(vm_name, sec_ips, vm_id) == False:
-            logging.debug("Failed to log default network rules, ignoring")
+    #the ipset of the vm ips, primary and secondary, refilled through a swap
+    #as the rules of the -def chain still match it until they are replaced
+    vmips = list(ips)
+    if vm_ip is not None:
+        vmips.insert(0, vm_ip)
+    program_rule_ipset(ipst, existing, vmipsetName, vmips, "iphash")
+
+    ipt.add("-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
+    ipt.add("-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
+    ipt.add("-A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
+    #allow dhcp
+    ipt.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
+    ipt.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
+
+    #don't let vm spoof its ip address
+    if vm_ip is not None:
+        ipt.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN")
+        ipt.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
+    ipt.add("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
+    ipt.add("-A " + vmchain + " -j DROP")
+    if batch != None:
+        # the logs are written once the batch is committed, the rule log by
+        # the caller queueing the rules of the vm
+        default_ebtables_rules(vmchain, vm_ip, vm_mac, vif, ips, batch.ebt)
+        if secIpSet == "1":
+            batch.secip_logs.append((vm_name, sec_ips, vm_id))
+        logging.debug("Queued default rules for vm " + vm_name)
+        return 'true'
 
     try:
-        execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
-        #allow dhcp
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
-
-        #don't let vm spoof its ip address
-        if vm_ip is not None:
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-        execute("iptables -A " + vmchain + " -j DROP")
+        ipst.commit()
+        ipt.commit()
     except:
         logging.debug("Failed to program default rules for vm " + vm_name)
         return 'false'
 
-    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif)
-    #default ebtables rules for vm secondary ips
-    ebtables_rules_vmip(vm_name, ips, "-I")
+    #default ebtables rules, including the ones of the vm secondary ips
+    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif, ips)
+
+    if secIpSet == "1":
+        if write_secip_log_for_vm(vm_name, sec_ips, vm_id) == False:
+            logging.debug("Failed to log default network rules, ignoring")
 
     if vm_ip is not None:
         if write_rule_log_for_vm(vmName, vm_id, vm_ip, domID, '_initial_', '-1') == False:
@@ -536,16 +837,22 @@ def post_default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, dhcpS
         pass
     if write_rule_log_for_vm(vm_name, vm_id, vm_ip, domID, '_initial_', '-1') == False:
             logging.debug("Failed to log default network rules, ignoring")
-def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+def bridge_firewall_rules_for_vm(vmName):
+    """Returns the '-D' commands of the bridge firewall jumps to the chains of a vm"""
     vm_name = vmName
     if vm_name.startswith('i-') or vm_name.startswith('r-'):
 	vm_name = '-'.join(vm_name.split('-')[:-1]) + "-def"
 
     vmchain = vm_name
 
-    delcmd = """iptables-save | awk '/BF(.*)physdev-is-bridged(.*)%s/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain
-    delcmds = execute(delcmd).split('\n')
-    delcmds.pop()
+    delcmds = []
+    for line in rule_index('iptables').references(vmchain):
+        if line.startswith('-A BF') and 'physdev-is-bridged' in line:
+            delcmds.append("-D" + line[2:])
+    return delcmds
+
+def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+    delcmds = bridge_firewall_rules_for_vm(vmName)
     for cmd in delcmds:
         try:
             execute("iptables " + cmd)
@@ -615,11 +922,11 @@ def network_rules_for_rebooted_vm(vmName):
 
     delete_rules_for_vm_in_bridge_firewall_chain(vm_name)
 
-    brName = execute("iptables-save | awk -F '-j ' '/FORWARD -o(.*)physdev-is-bridged(.*)BF/ {print $2}'").strip()
-    if brName is None or brName is "":
+    bridges = bridge_firewalls()
+    if not bridges:
         brName = "cloudbr0"
     else:
-        brName = execute("iptables-save |grep physdev-is-bridged |grep FORWARD |grep BF |grep '\-o' |awk '{print $4}' | head -1").strip()
+        brName = bridges[0][0]
 
     if 1 in [ vm_name.startswith(c) for c in ['r-', 's-', 'v-'] ]:
 
@@ -631,22 +938,19 @@ def network_rules_for_rebooted_vm(vmName):
 
     vifs = getVifs(vmName)
     logging.debug(vifs, brName)
+    brfw = getBrfw(brName)
     for v in vifs:
-        execute("iptables -A " + getBrfw(brName) + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j "+ vmchain_default)
-        execute("iptables -A " + getBrfw(brName) + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j "+ vmchain_default)
+        execute("iptables -A " + brfw + "-IN " + " -m physdev --physdev-is-bridged --physdev-in " + v + " -j "+ vmchain_default)
+        execute("iptables -A " + brfw + "-OUT " + " -m physdev --physdev-is-bridged --physdev-out " + v + " -j "+ vmchain_default)
 
     #change antispoof rule in vmchain
     try:
-        delcmd = """iptables-save | awk '/-A %s(.*)physdev/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain_default
-        inscmd = """iptables-save | awk '/-A %s(.*)physdev/ { gsub(/vnet[0-9]+/, "%s") ; sub(/-A/, "-D", $1) ; print }'""" % ( vmchain_default,vifs[0] )
+        lines = [line for line in rule_index('iptables').chain_rules(vmchain_default) if 'physdev' in line]
         ipts = []
-        for cmd in [delcmd, inscmd]:
-            logging.debug(cmd)
-            cmds = execute(cmd).split('\n')
-            cmds.pop()
-            for c in cmds:
-                    ipt = "iptables " + c
-                    ipts.append(ipt)
+        for line in lines:
+            ipts.append("iptables -D" + line[2:])
+        for line in lines:
+            ipts.append("iptables -D" + re.sub(r'vnet[0-9]+', vifs[0], line)[2:])
 
         for ipt in ipts:
             try:
@@ -683,8 +987,7 @@ def cleanup_rules_for_dead_vms():
 
 def cleanup_rules():
     try:
-        chainscmd = """iptables-save | grep -P '^:(?!.*-(def|eg))' | awk '{sub(/^:/, "", $1) ; print $1}'"""
-        chains = execute(chainscmd).split('\n')
+        chains = [chain for chain in rule_index('iptables').all_chains() if not re.search('-(def|eg)', chain)]
         cleanup = []
         for chain in chains:
             if 1 in [ chain.startswith(c) for c in ['r-', 'i-', 's-', 'v-'] ]:
@@ -700,9 +1003,14 @@ def cleanup_rules():
                     logging.debug("vm " + vm_name + " is not running or paused, cleaning up iptable rules")
                     cleanup.append(vm_name)
 
-        chainscmd = """ebtables-save | awk '/:i/ { gsub(/(^:|-(in|out))/, "") ; print $1}'"""
-        chains = execute(chainscmd).split('\n')
+        chains = []
+        for chain in rule_index('ebtables').all_chains():
+            chain = re.sub('-(in|out)(-ips)?$', '', chain)
+            if chain.startswith('i') and chain not in chains:
+                chains.append(chain)
         for chain in chains:
+            if chain in cleanup:
+                continue
             if 1 in [ chain.startswith(c) for c in ['r-', 'i-', 's-', 'v-'] ]:
                 vm_name = chain
 
@@ -745,9 +1053,24 @@ def check_rule_log_for_vm(vmName, vmId, vmIP, domID, signature, seqno):
         remove_rule_log_for_vm(vm_name)
         return [True, True, True, True, True, True]
 
-    return [(vm_name != _vmName), (vmId != _vmID), (vmIP != _vmIP), (domID != _domID), (signature != _signature),(seqno != _seqno)]
+    return [(vm_name != _vmName), (vmId != _vmID), (vmIP != _vmIP), (str(domID) != _domID), (signature != _signature),(seqno != _seqno)]
+
+def get_applied_rules_for_vm(vmName):
+    """Returns the rules of the vm chains recorded after the first line of its rule log
+
+    None means they are unknown, e.g. the chains were reset since.
+    """
+    logfilename = logpath + vmName + ".log"
+    try:
+        lines = [line.rstrip() for line in open(logfilename)]
+    except:
+        return None
+
+    if len(lines) < 2:
+        return None
+    return lines[1:]
 
-def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno):
+def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno, rules=None):
     vm_name = vmName
     logfilename = logpath + vm_name + ".log"
     logging.debug("Writing log to " + logfilename)
@@ -757,6 +1080,10 @@ def write_rule_log_for_vm(vmName, vmID, vmIP, domID, signature, seqno):
     try:
         logf.write(output)
         logf.write('\n')
+        if rules != None:
+            for rule in rules:
+                logf.write(rule)
+                logf.write('\n')
     except:
         logging.debug("Failed to write to rule log file " + logfilename)
         result = False
@@ -781,8 +1108,117 @@ def remove_rule_log_for_vm(vmName):
 def egress_chain_name(vm_name):
     return vm_name + "-eg"
 
-def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif, brname, sec_ips):
+class RuleBatch:
+    """The rules of several vms, programmed with one restore per table
+
+    The ipsets go first, in one 'ipset -R', so that the iptables rules
+    referring to them can be loaded; then come the iptables and ebtables
+    transactions, the destruction of the ipsets no longer used and the
+    secondary ip and rule logs. Nothing is changed on the host until
+    commit().
+    """
+    def __init__(self):
+        self.ipt = RuleTransaction("iptables", "filter")
+        self.ebt = RuleTransaction("ebtables", "nat")
+        self.ipst = IpsetTransaction()
+        self.stale = IpsetTransaction()
+        self.existing = None
+        self.secip_logs = []
+        self.logs = []
+
+    def mark(self):
+        return (len(self.ipt.chains), len(self.ipt.rules), len(self.ebt.chains), len(self.ebt.rules),
+                len(self.ipst.commands), len(self.stale.commands), len(self.secip_logs), len(self.logs))
+
+    def rollback(self, mark):
+        """Drops what was queued since mark was taken"""
+        (self.ipt.chains[mark[0]:], self.ipt.rules[mark[1]:], self.ebt.chains[mark[2]:], self.ebt.rules[mark[3]:],
+         self.ipst.commands[mark[4]:], self.stale.commands[mark[5]:], self.secip_logs[mark[6]:],
+         self.logs[mark[7]:]) = ([], [], [], [], [], [], [], [])
+
+    def ipset_names(self):
+        if self.existing == None:
+            self.existing = ipset_names()
+        return self.existing
+
+    def commit(self):
+        """Returns the names of the vms whose rule log could not be written"""
+        self.ipst.commit()
+        self.ipt.commit()
+        self.ebt.commit()
+        try:
+            self.stale.commit()
+        except:
+            logging.debug("Ignoring failure to destroy stale rule ipsets")
+        for log in self.secip_logs:
+            if write_secip_log_for_vm(*log) == False:
+                logging.debug("Failed to log secondary ips of " + log[0] + ", ignoring")
+        failed = []
+        for log in self.logs:
+            if write_rule_log_for_vm(*log) == False:
+                failed.append(log[0])
+        return failed
+
+def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif, brname, sec_ips, deflated=False):
   try:
+    batch = RuleBatch()
+    queue_network_rules(batch, vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif, brname, sec_ips, deflated)
+    if batch.commit():
+        return 'false'
+
+    return 'true'
+  except:
+    exceptionText = traceback.format_exc()
+    logging.debug("Failed to network rule !: " + exceptionText)
+
+def iter_rules(stream, deflated=False, chunksize=65536):
+    """Yields the ';' terminated rules read from a file object
+
+    With deflated the content is zlib compressed and base64 encoded, as the
+    rules given to the XenServer vmops plugin. Rules are decoded chunk by
+    chunk and handed out as soon as they are complete.
+    """
+    decompressor = zlib.decompressobj()
+    encoded = ""
+    pending = ""
+    while True:
+        chunk = stream.read(chunksize)
+        if deflated:
+            if chunk:
+                encoded += "".join(chunk.split())
+                usable = len(encoded) - len(encoded) % 4
+                text = decompressor.decompress(base64.b64decode(encoded[:usable]))
+                encoded = encoded[usable:]
+            else:
+                text = decompressor.flush()
+        else:
+            text = chunk
+        pending += text
+        start = 0
+        end = pending.find(';')
+        while end != -1:
+            yield pending[start:end]
+            start = end + 1
+            end = pending.find(';', start)
+        pending = pending[start:]
+        if not chunk:
+            break
+
+def rule_lines(rules, deflated=False):
+    """The rules of a --rules string, or of a file object such as stdin"""
+    if rules == "" or rules == None:
+        return iter([])
+    if isinstance(rules, basestring):
+        rules = StringIO.StringIO(rules)
+    return iter_rules(rules, deflated)
+
+def queue_network_rules(batch, vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif, brname, sec_ips, deflated=False, refill=False):
+    """Queues the rules of a vm in batch, returns False when they are already programmed
+
+    rules is either a string or a file object, see rule_lines. With refill
+    the vm chains are flushed and refilled instead of updated, e.g. when a
+    failed commit may have left them partly programmed.
+    """
     vmName = vm_name
     domId = getvmId(vmName)
 
@@ -791,25 +1227,29 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
 
     if not 1 in changes:
         logging.debug("Rules already programmed for vm " + vm_name)
-        return 'true'
-
-    if changes[0] or changes[1] or changes[2] or changes[3]:
-        default_network_rules(vmName, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
+        return False
 
-    if rules == "" or rules == None:
-        lines = []
-    else:
-        lines = rules.split(';')[:-1]
+    lines = rule_lines(rules, deflated)
 
     logging.debug("    programming network rules for IP: " + vm_ip + " vmname=" + vm_name)
-    try:
-      vmchain = vm_name
-      execute("iptables -F " + vmchain)
-      egress_vmchain = egress_chain_name(vm_name)
-      execute("iptables -F " + egress_vmchain)
-    except:
-      logging.debug("Error flushing iptables rules for " + vmchain + ". Presuming firewall rules deleted, re-initializing." )
-      default_network_rules(vm_name, vm_id, vm_ip, vmMac, vif, brname)
+    reinit = changes[0] or changes[1] or changes[2] or changes[3]
+    if not reinit:
+        index = rule_index('iptables')
+        if not index.has_chain(vm_name) or not index.has_chain(egress_chain_name(vm_name)):
+            logging.debug("Error listing iptables rules for " + vm_name + ". Presuming firewall rules deleted, re-initializing." )
+            reinit = True
+
+    # the rules in the vm chains, unless the chains are re-initialized
+    applied = None
+    if reinit:
+        default_network_rules(vmName, vm_id, vm_ip, vmMac, vif, brname, sec_ips, batch)
+    elif not refill:
+        applied = get_applied_rules_for_vm(vmName)
+
+    # the rules wanted in the chains, as '-I' or, for the final ones, '-A' commands
+    rulelist = []
+    # the cidrs of each rule are matched through a hash:net ipset
+    ruleipsets = {}
     egressrule = 0
     for line in lines:
 
@@ -826,125 +1266,220 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
         allow_any = False
         if ruletype == 'E':
             vmchain = egress_chain_name(vm_name)
-            direction = "-d"
+            direction = "dst"
             action = "RETURN"
             egressrule = egressrule + 1
         else:
             vmchain = vm_name
             action = "ACCEPT"
-            direction = "-s"
+            direction = "src"
         if '0.0.0.0/0' in ips:
             i = ips.index('0.0.0.0/0')
             del ips[i]
             allow_any = True
         range = start + ":" + end
-        if ips:
+        ipsetname = rule_ipset_name(vm_name, ':'.join(tokens))
+        if ips and ipsetname in ruleipsets:
+            # same rule listed twice, its set already has a matching rule
+            ruleipsets[ipsetname] += ips
+        elif ips:
+            ruleipsets[ipsetname] = ips
+            match = " -m set --set " + ipsetname + " " + direction
             if protocol == 'all':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -m state --state NEW " + direction + " " + ip + " -j "+action)
+                rulelist.append("-I " + vmchain + " -m state --state NEW" + match + " -j "+action)
             elif protocol != 'icmp':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW " + direction + " " + ip + " -j "+ action)
+                rulelist.append("-I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW" + match + " -j "+ action)
             else:
                 range = start + "/" + end
                 if start == "-1":
                     range = "any"
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " " + direction + " " + ip + " -j "+ action)
+                rulelist.append("-I " + vmchain + " -p icmp --icmp-type " + range + match + " -j "+ action)
 
         if allow_any and protocol != 'all':
             if protocol != 'icmp':
-                execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW -j "+ action)
+                rulelist.append("-I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW -j "+ action)
             else:
                 range = start + "/" + end
                 if start == "-1":
                     range = "any"
-                execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " -j "+action)
+                rulelist.append("-I " + vmchain + " -p icmp --icmp-type " + range + " -j "+action)
 
     egress_vmchain = egress_chain_name(vm_name)
     if egressrule == 0 :
-        iptables = "iptables -A " + egress_vmchain + " -j RETURN"
-        execute(iptables)
+        rulelist.append("-A " + egress_vmchain + " -j RETURN")
     else:
-        iptables = "iptables -A " + egress_vmchain + " -j DROP"
-        execute(iptables)
+        rulelist.append("-A " + egress_vmchain + " -j DROP")
 
     vmchain = vm_name
-    iptables = "iptables -A " + vmchain + " -j DROP"
-    execute(iptables)
-
-    if write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno) == False:
-        return 'false'
-
-    return 'true'
-  except:
-    exceptionText = traceback.format_exc()
-    logging.debug("Failed to network rule !: " + exceptionText)
-
-def getVifs(vmName):
-    vifs = []
-    xmlfile = virshdumpxml(vmName)
-    if xmlfile == None:
-        return vifs
+    rulelist.append("-A " + vmchain + " -j DROP")
+    seen = {}
+    unique = []
+    for rule in rulelist:
+        if rule not in seen:
+            seen[rule] = None
+            unique.append(rule)
+    rulelist = unique
+
+    ipt = batch.ipt
+    if applied == None:
+        # both chains are flushed and refilled in a single iptables-restore
+        ipt.chain(vm_name)
+        ipt.chain(egress_chain_name(vm_name))
+        for rule in rulelist:
+            ipt.add(rule)
+    else:
+        # only the rules that changed, deleted first so the final rules stay last
+        wanted = dict.fromkeys(rulelist)
+        present = dict.fromkeys(applied)
+        for rule in applied:
+            if rule not in wanted:
+                ipt.add("-D" + rule[2:])
+        for rule in rulelist:
+            if rule not in present:
+                ipt.add(rule)
+                present[rule] = None
+        logging.debug("Updating rules of %s incrementally" % vm_name)
+
+    existing = batch.ipset_names()
+    for ipsetname in ruleipsets.keys():
+        program_rule_ipset(batch.ipst, existing, ipsetname, ruleipsets[ipsetname])
+    destroy_rule_ipsets(vm_name, ruleipsets.keys(), existing, batch.stale)
+
+    batch.logs.append((vmName, vm_id, vm_ip, domId, signature, seqno, rulelist))
+    return True
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        target = network.getElementsByTagName('target')[0]
-        nicdev = target.getAttribute("dev").strip()
-        vifs.append(nicdev)
-    return vifs
+def add_network_rules_batch(specs):
+    """Programs the rules of the vms described in the json file specs at once
 
-def getVifsForBridge(vmName, brname):
-    vifs = []
-    xmlfile = virshdumpxml(vmName)
-    if xmlfile == None:
-        return vifs
+    specs holds a list of objects with the keys of the add_network_rules
+    options: vmname, vmid, vmip, vmmac, vif, brname, sig, seq, rules,
+    nicsecips and deflated. Prints a '<vmname>,<true|false>' line per vm.
+    When the batch cannot be committed, the rules of each vm are programmed
+    again in a transaction of their own.
+    """
+    f = open(specs)
+    try:
+        vms = json.load(f)
+    finally:
+        f.close()
+
+    def queue(batch, vm, refill=False):
+        queue_network_rules(batch, vm['vmname'], vm['vmid'], vm['vmip'], vm['sig'], vm['seq'], vm['vmmac'],
+                            vm.get('rules'), vm['vif'], vm['brname'], vm.get('nicsecips', '0:'), vm.get('deflated', False),
+                            refill)
+
+    batch = RuleBatch()
+    results = []
+    queued = []
+    for vm in vms:
+        mark = batch.mark()
+        try:
+            queue(batch, vm)
+            result = [vm['vmname'], 'true']
+            queued.append((vm, result))
+        except:
+            batch.rollback(mark)
+            logging.debug("Failed to queue network rules for " + str(vm.get('vmname')) + ": " + traceback.format_exc())
+            result = [str(vm.get('vmname')), 'false']
+        results.append(result)
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        source = network.getElementsByTagName('source')[0]
-        bridge = source.getAttribute("bridge").strip()
-        if bridge == brname:
-            target = network.getElementsByTagName('target')[0]
-            nicdev = target.getAttribute("dev").strip()
-            vifs.append(nicdev)
-    return list(set(vifs))
+    try:
+        failed = batch.commit()
+        for (vm, result) in queued:
+            if vm['vmname'] in failed:
+                result[1] = 'false'
+    except:
+        logging.debug("Failed to program network rules in batch, programming them vm by vm: " + traceback.format_exc())
+        for (vm, result) in queued:
+            single = RuleBatch()
+            try:
+                queue(single, vm, True)
+                if single.commit():
+                    result[1] = 'false'
+            except:
+                logging.debug("Failed to program network rules for " + vm['vmname'] + ": " + traceback.format_exc())
+                result[1] = 'false'
 
-def getBridges(vmName):
-    bridges = []
-    xmlfile = virshdumpxml(vmName)
-    if xmlfile == None:
-        return bridges
+    for result in results:
+        print ','.join(result)
 
+def parse_domain_xml(xmlfile):
+    """Returns the (vif, bridge, mac) of each interface of a domain xml"""
+    interfaces = []
     dom = xml.dom.minidom.parseString(xmlfile)
     for network in dom.getElementsByTagName("interface"):
+        vif = bridge = mac = None
+        for target in network.getElementsByTagName('target'):
+            vif = target.getAttribute("dev").strip()
         for source in network.getElementsByTagName('source'):
             bridge = source.getAttribute("bridge").strip()
-            bridges.append(bridge)
-    return list(set(bridges))
+        for address in network.getElementsByTagName('mac'):
+            mac = address.getAttribute("address").strip()
+        interfaces.append((vif, bridge, mac))
+    return interfaces
+
+def get_domain_info(vmName):
+    """Returns the model of a domain, or None when it does not exist
+
+    The domain xml is fetched once per command, run_command clears the
+    cache so that a restarted vm or a plugged nic is seen by the next one.
+    """
+    info = domain_infos.get(vmName)
+    if info != None:
+        return info
+    dom = lookup_domain(vmName)
+    if dom == None:
+        return None
 
-def getvmId(vmName):
+    interfaces = parse_domain_xml(dom.XMLDesc(0))
+    info = {'interfaces': interfaces,
+            'vifs': [vif for (vif, bridge, mac) in interfaces if vif],
+            'bridges': list(set([bridge for (vif, bridge, mac) in interfaces if bridge])),
+            'macs': [mac for (vif, bridge, mac) in interfaces if mac]}
+    domain_infos[vmName] = info
+    return info
 
-    conn = libvirt.openReadOnly('qemu:///system')
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
+def getVifs(vmName):
+    info = get_domain_info(vmName)
+    if info == None:
+        return []
+    return list(info['vifs'])
 
-    try:
-        dom = (conn.lookupByName (vmName))
-    except libvirt.libvirtError:
-        return None
+def getVifsForBridge(vmName, brname):
+    info = get_domain_info(vmName)
+    if info == None:
+        return []
+    return list(set([vif for (vif, bridge, mac) in info['interfaces'] if vif and bridge == brname]))
+
+def getBridges(vmName):
+    info = get_domain_info(vmName)
+    if info == None:
+        return []
+    return list(info['bridges'])
 
-    conn.close()
+def getvmId(vmName):
+    dom = lookup_domain(vmName)
+    if dom == None:
+        return None
 
     return dom.ID()
 
+def bridge_firewalls():
+    """Returns the (bridge, bridge firewall chain) of the FORWARD rules handing bridged traffic over"""
+    bridges = []
+    for line in rule_index('iptables').chain_rules('FORWARD'):
+        tokens = line.split()
+        if '-o' in tokens and '-j' in tokens and 'physdev-is-bridged' in line:
+            brfw = tokens[tokens.index('-j') + 1]
+            if brfw.startswith('BF'):
+                bridges.append((tokens[tokens.index('-o') + 1], brfw))
+    return bridges
+
 def getBrfw(brname):
-    cmd = "iptables-save |grep physdev-is-bridged |grep FORWARD |grep BF |grep '\-o' | grep -w " + brname  + "|awk '{print $9}' | head -1"
-    brfwname = bash("-c", cmd).stdout.strip()
-    if brfwname == "":
-        brfwname = "BF-" + brname
-    return brfwname
+    for (bridge, brfw) in bridge_firewalls():
+        if bridge == brname:
+            return brfw
+    return "BF-" + brname
     
 def addFWFramework(brname):
     try:
@@ -960,26 +1495,15 @@ def addFWFramework(brname):
         return False
 
     brfw = getBrfw(brname)
-    try:
-        execute("iptables -L " + brfw)
-    except:
-        execute("iptables -N " + brfw)
-
     brfwout = brfw + "-OUT"
-    try:
-        execute("iptables -L " + brfwout)
-    except:
-        execute("iptables -N " + brfwout)
-
     brfwin = brfw + "-IN"
-    try:
-        execute("iptables -L " + brfwin)
-    except:
-        execute("iptables -N " + brfwin)
+    index = rule_index('iptables')
+    for chain in [brfw, brfwout, brfwin]:
+        if not index.has_chain(chain):
+            execute("iptables -N " + chain)
 
     try:
-        refs = execute("""iptables -n -L " + brfw + " | awk '/%s(.*)references/ {gsub(/\(/, "") ;print $3}'""" % brfw).strip()
-        if refs == "0":
+        if len(rule_index('iptables').references(brfw)) == 0:
             execute("iptables -I FORWARD -i " + brname + " -j DROP")
             execute("iptables -I FORWARD -o " + brname + " -j DROP")
             execute("iptables -I FORWARD -i " + brname + " -m physdev --physdev-is-bridged -j " + brfw)
@@ -999,8 +1523,7 @@ def addFWFramework(brname):
             return False
         return False
 
-if __name__ == '__main__':
-    logging.basicConfig(filename="/var/log/cloudstack/agent/security_group.log", format="%(asctime)s - %(message)s", level=logging.DEBUG)
+def make_parser():
     parser = OptionParser()
     parser.add_option("--vmname", dest="vmName")
     parser.add_option("--vmip", dest="vmIP")
@@ -1010,6 +1533,8 @@ if __name__ == '__main__':
     parser.add_option("--sig", dest="sig")
     parser.add_option("--seq", dest="seq")
     parser.add_option("--rules", dest="rules")
+    parser.add_option("--rules-file", dest="rulesFile", help="read the rules from a file, - for stdin")
+    parser.add_option("--deflated", dest="deflated", action="store_true", default=False, help="the rules are zlib compressed and base64 encoded")
     parser.add_option("--brname", dest="brname")
     parser.add_option("--localbrname", dest="localbrname")
     parser.add_option("--dhcpSvr", dest="dhcpSvr")
@@ -1017,11 +1542,14 @@ if __name__ == '__main__':
     parser.add_option("--hostMacAddr", dest="hostMacAddr")
     parser.add_option("--nicsecips", dest="nicSecIps")
     parser.add_option("--action", dest="action")
-    (option, args) = parser.parse_args()
-    if len(args) == 0:
-        logging.debug("No command to execute")
-        sys.exit(1)
-    cmd = args[0]
+    parser.add_option("--specs", dest="specs")
+    parser.add_option("--socket", dest="socket", default=daemon_socket)
+    return parser
+
+def run_command(cmd, option, args):
+    # the rules and domains may have been changed since the previous command of a daemon
+    invalidate_snapshots()
+    domain_infos.clear()
     if cmd == "can_bridge_firewall":
         can_bridge_firewall(args[1])
     elif cmd == "default_network_rules":
@@ -1033,7 +1561,20 @@ if __name__ == '__main__':
     elif cmd == "get_rule_logs_for_vms":
         get_rule_logs_for_vms()
     elif cmd == "add_network_rules":
-        add_network_rules(option.vmName, option.vmID, option.vmIP, option.sig, option.seq, option.vmMAC, option.rules, option.vif, option.brname, option.nicSecIps)
+        rules = option.rules
+        rulesfile = None
+        if option.rulesFile == "-":
+            rules = sys.stdin
+        elif option.rulesFile:
+            rulesfile = open(option.rulesFile)
+            rules = rulesfile
+        try:
+            add_network_rules(option.vmName, option.vmID, option.vmIP, option.sig, option.seq, option.vmMAC, rules, option.vif, option.brname, option.nicSecIps, option.deflated)
+        finally:
+            if rulesfile != None:
+                rulesfile.close()
+    elif cmd == "add_network_rules_batch":
+        add_network_rules_batch(option.specs)
     elif cmd == "network_rules_vmSecondaryIp":
         network_rules_vmSecondaryIp(option.vmName, option.nicSecIps, option.action)
     elif cmd == "cleanup_rules":
@@ -1043,3 +1584,193 @@ if __name__ == '__main__':
     else:
         logging.debug("Unknown command: " + cmd)
         sys.exit(1)
+
+class Request:
+    """A command line received by the daemon, with its input, output and exit status"""
+    def __init__(self, argv, stdin=""):
+        self.argv = argv
+        self.stdin = stdin
+        self.status = None
+        self.output = ""
+        self.replaced_by = None
+        self.done = threading.Event()
+
+    def key(self):
+        """The vm of an add_network_rules, which a later one for the same vm replaces"""
+        (option, args) = make_parser().parse_args(self.argv)
+        if args and args[0] == "add_network_rules":
+            return option.vmName
+        return None
+
+    def vm(self):
+        return make_parser().parse_args(self.argv)[0].vmName
+
+    def run(self):
+        (stdin, stdout) = (sys.stdin, sys.stdout)
+        sys.stdin = StringIO.StringIO(self.stdin)
+        sys.stdout = StringIO.StringIO()
+        try:
+            try:
+                (option, args) = make_parser().parse_args(self.argv)
+                if len(args) == 0:
+                    logging.debug("No command to execute")
+                    sys.exit(1)
+                run_command(args[0], option, args)
+                self.status = 0
+            except SystemExit, e:
+                self.status = e.code or 0
+            except:
+                logging.debug("Failed to run " + " ".join(self.argv) + ": " + traceback.format_exc())
+                self.status = 1
+        finally:
+            self.output = sys.stdout.getvalue()
+            (sys.stdin, sys.stdout) = (stdin, stdout)
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.replaced_by != None:
+            return self.replaced_by.wait()
+        return (self.status, self.output)
+
+class RequestQueue:
+    """Runs the daemon requests one at a time, in order of arrival
+
+    An add_network_rules still waiting in the queue is replaced by a later
+    one for the same vm, as long as no other command for that vm is queued
+    in between; both callers then get the result of the later one.
+    """
+    def __init__(self):
+        self.requests = []
+        self.cond = threading.Condition()
+
+    def submit(self, request):
+        key = request.key()
+        self.cond.acquire()
+        try:
+            if key != None:
+                for i in range(len(self.requests) - 1, -1, -1):
+                    queued = self.requests[i]
+                    if queued.vm() != key:
+                        continue
+                    if queued.key() == key:
+                        logging.debug("Coalescing add_network_rules for " + key)
+                        del self.requests[i]
+                        queued.replaced_by = request
+                        queued.done.set()
+                    break
+            self.requests.append(request)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return request.wait()
+
+    def serve(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.requests:
+                    self.cond.wait()
+                request = self.requests.pop(0)
+            finally:
+                self.cond.release()
+            request.run()
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Reads the request, writes the exit status line and the output
+
+    A request is the number of arguments on a line, the NUL terminated
+    arguments and the standard input of the command up to EOF.
+    """
+    def handle(self):
+        count = int(self.rfile.readline())
+        parts = self.rfile.read().split("\0", count)
+        (status, output) = self.server.queue.submit(Request(parts[:count], parts[count]))
+        self.wfile.write(str(status) + "\n" + output)
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def run_daemon(path):
+    """Serves the commands of the CLI on a unix socket, keeping libvirt and rule state in memory"""
+    if os.path.exists(path):
+        os.remove(path)
+    server = DaemonServer(path, RequestHandler)
+    os.chmod(path, 0600)
+    server.queue = RequestQueue()
+    worker = threading.Thread(target=server.queue.serve)
+    worker.setDaemon(True)
+    worker.start()
+    logging.debug("Serving security group commands on " + path)
+    server.serve_forever()
+
+def forward_to_daemon(path, argv, stdin=""):
+    """Runs the command in the daemon, returns its (status, output) or None if it is not running
+
+    Once the command is sent it is never run locally as well: when the daemon
+    does not answer in daemon_timeout seconds, so that a hung daemon does not
+    block the agent, the command fails.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(daemon_timeout)
+    try:
+        try:
+            sock.connect(path)
+            sock.sendall("%d\n%s%s" % (len(argv), "".join([arg + "\0" for arg in argv]), stdin))
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error, e:
+            logging.debug("Security group daemon not reachable, running locally: " + str(e))
+            return None
+        chunks = []
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.error, e:
+            logging.debug("No answer from the security group daemon for " + " ".join(argv) + ": " + str(e))
+            return (1, "")
+    finally:
+        sock.close()
+    reply = "".join(chunks)
+    if "\n" not in reply:
+        logging.debug("Incomplete answer from the security group daemon for " + " ".join(argv))
+        return (1, "")
+    (status, output) = reply.split("\n", 1)
+    return (int(status), output)
+
+def daemon_argv(argv, option):
+    """argv with the paths it names made absolute, as the daemon has its own working directory"""
+    argv = list(argv)
+    # the last occurrence of an option wins
+    if option.rulesFile and option.rulesFile != "-":
+        argv += ["--rules-file", os.path.abspath(option.rulesFile)]
+    if option.specs:
+        argv += ["--specs", os.path.abspath(option.specs)]
+    return argv
+
+if __name__ == '__main__':
+    logging.basicConfig(filename="/var/log/cloudstack/agent/security_group.log", format="%(asctime)s - %(message)s", level=logging.DEBUG)
+    parser = make_parser()
+    (option, args) = parser.parse_args()
+    if len(args) == 0:
+        logging.debug("No command to execute")
+        sys.exit(1)
+    cmd = args[0]
+    if cmd == "daemon":
+        run_daemon(option.socket)
+    else:
+        result = None
+        if os.path.exists(option.socket):
+            stdin = ""
+            if option.rulesFile == "-":
+                stdin = sys.stdin.read()
+                sys.stdin = StringIO.StringIO(stdin)
+            result = forward_to_daemon(option.socket, daemon_argv(sys.argv[1:], option), stdin)
+        if result == None:
+            run_command(cmd, option, args)
+        else:
+            (status, output) = result
+            sys.stdout.write(output)
+            sys.exit(status)